@@ -3,21 +3,23 @@ Runs the specified command
 """
 
 import sys
-from argparse import ArgumentParser, Namespace
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
 from logging import debug, error
 
 from rich.traceback import install
 
 from commands.local import flavour_action, install_logger
 from flavours.shared import (
-    build_image,
-    copy_image_to_host,
-    load_image_to_host,
-    push_image,
-    remove_image_file,
-    save_image_to_dind,
+    build_images,
+    push_images,
+    remove_build_context,
+    save_image_archive,
+    save_image_to_host,
 )
+from lib.dekickrc import get_dekickrc_value
 from lib.dind import dind_container
+from lib.environments import get_environments
+from lib.image_report import report_image_size
 from lib.misc import check_argparse_arg
 from lib.parser_defaults import parser_default_args, parser_default_funcs
 
@@ -33,7 +35,45 @@ def arguments(parser: ArgumentParser):
     parser.set_defaults(func=main)
     parser_default_args(parser)
     parser.add_argument(
-        "--target-image", required=True, help="target docker image name and tag"
+        "--target-image",
+        required=True,
+        action="append",
+        type=parse_target_image,
+        help="target docker image name and tag, optionally followed by comma "
+        + "separated stage=<Dockerfile stage>, env=<environment> (passed as "
+        + "DEKICK_ENVIRONMENT build arg) and arg.<NAME>=<value> build args, "
+        + "can be repeated to build several images at once",
+    )
+    parser.add_argument(
+        "--concurrency",
+        required=False,
+        type=int,
+        default=2,
+        help="how many images are built and pushed at the same time, default is 2",
+    )
+    parser.add_argument(
+        "--image-report",
+        action="store_true",
+        help="show size of built images and their layers, it's always shown when "
+        + "dekick.build.max_image_size is set in .dekickrc.yml",
+    )
+
+    cache_parser = parser.add_argument_group(
+        title="BuildKit cache options, override dekick.build from .dekickrc.yml"
+    )
+    cache_parser.add_argument(
+        "--cache-from",
+        action="append",
+        required=False,
+        help="cache source, e.g. type=local,src=.cache/build or "
+        + "type=registry,ref=registry.example.com/app:cache (can be repeated)",
+    )
+    cache_parser.add_argument(
+        "--cache-to",
+        action="append",
+        required=False,
+        help="cache destination, e.g. type=local,dest=.cache/build,mode=max "
+        + "(can be repeated)",
     )
 
     docker_parser = parser.add_argument_group(
@@ -54,7 +94,17 @@ def arguments(parser: ArgumentParser):
         help="password to login to docker registry",
     )
     docker_parser.add_argument(
-        "--save", action="store_true", help="should image saved to hosts Docker daemon"
+        "--save",
+        action="store_true",
+        help="should image saved to hosts Docker daemon (with zstd compression "
+        + "it's saved as OCI archive to project directory instead)",
+    )
+    docker_parser.add_argument(
+        "--compression",
+        required=False,
+        choices=["gzip", "zstd"],
+        help="compression of image layers when pushing or saving, overrides "
+        + "dekick.build.compression from .dekickrc.yml",
     )
 
 
@@ -67,62 +117,61 @@ def main(parser: Namespace, args: list):  # pylint: disable=unused-argument
     """
     parser_default_funcs(parser)
 
-    sys.exit(
-        build(
-            target_image=parser.target_image,
-            docker_login_user=parser.docker_login_user,
-            docker_login_password=parser.docker_login_password,
-            docker_registry=parser.docker_registry,
-            push=parser.push,
-            save=parser.save,
-            log_level=parser.log_level or "INFO",
-            log_filename=parser.log_filename or "dekick-build.log",
-        )
-    )
-
-
-# pylint: disable=too-many-arguments
-def build(
-    target_image: str,
-    docker_login_user: str,
-    docker_login_password: str,
-    docker_registry: str,
-    push: bool,
-    save: bool,
-    log_level: str,
-    log_filename: str,
-) -> int:
+    sys.exit(build(parser))
+
+
+def build(parser: Namespace) -> int:
     """
-    Build an image
+    Build images, all targets share one DinD container and flavour build
     """
-    install_logger(log_level, log_filename)
+    install_logger(
+        parser.log_level or "INFO", parser.log_filename or "dekick-build.log"
+    )
 
-    if push is True:
-        check_argparse_arg(docker_login_user, "--docker-login-user")
-        check_argparse_arg(docker_login_password, "--docker-login-password")
-        check_argparse_arg(docker_login_user, "--docker-login-user")
+    if parser.push is True:
+        check_argparse_arg(parser.docker_login_user, "--docker-login-user")
+        check_argparse_arg(parser.docker_login_password, "--docker-login-password")
+        check_argparse_arg(parser.docker_login_user, "--docker-login-user")
+
+    targets = parser.target_image
+    cache_from = (
+        parser.cache_from or get_dekickrc_value("dekick.build.cache_from") or []
+    )
+    cache_to = parser.cache_to or get_dekickrc_value("dekick.build.cache_to") or []
+    compression = str(
+        parser.compression or get_dekickrc_value("dekick.build.compression") or "gzip"
+    )
 
     try:
-        image_path = ""
         with dind_container():
             flavour_action("build")
-            build_image(target_image)
-
-            if push is True:
-                push_image(
-                    target_image,
-                    docker_login_user,
-                    docker_login_password,
-                    docker_registry,
-                )
-
-            if save is True:
-                image_path = save_image_to_dind(target_image)
-                copy_image_to_host(image_path)
-
-        if save is True and image_path != "":
-            load_image_to_host(image_path)
-            remove_image_file(image_path)
+            build_images(targets, cache_from, cache_to, parser.concurrency, compression)
+
+            try:
+                max_size = get_dekickrc_value("dekick.build.max_image_size") or ""
+
+                if max_size or parser.image_report:
+                    for target in targets:
+                        report_image_size(target["image"], str(max_size), compression)
+
+                if parser.push is True:
+                    push_images(
+                        targets,
+                        docker_login_user=parser.docker_login_user,
+                        docker_login_password=parser.docker_login_password,
+                        docker_registry=parser.docker_registry,
+                        concurrency=parser.concurrency,
+                        compression=compression,
+                    )
+
+                if parser.save is True:
+                    for target in targets:
+                        if compression == "zstd":
+                            save_image_archive(target)
+                        else:
+                            save_image_to_host(target["image"])
+            finally:
+                remove_build_context()
 
     except Exception as err:  # pylint: disable=broad-except
         error("Error running build")
@@ -130,3 +179,28 @@ def build(
         return 1
 
     return 0
+
+
+def parse_target_image(value: str) -> dict:
+    """Parse `image[,stage=<stage>][,env=<environment>][,arg.<NAME>=<value>]`"""
+    image, *options = value.split(",")
+    target = {"image": image, "stage": "", "build_args": {}}
+
+    if image == "":
+        raise ArgumentTypeError("missing image name")
+
+    for option in options:
+        key, _, option_value = option.partition("=")
+
+        if key == "stage":
+            target["stage"] = option_value
+        elif key == "env":
+            if option_value not in get_environments():
+                raise ArgumentTypeError(f"unknown environment {option_value}")
+            target["build_args"]["DEKICK_ENVIRONMENT"] = option_value
+        elif key.startswith("arg.") and key != "arg.":
+            target["build_args"][key[4:]] = option_value
+        else:
+            raise ArgumentTypeError(f"unknown option {key} in {value}")
+
+    return target
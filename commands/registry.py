@@ -0,0 +1,41 @@
+"""
+Manages the Docker registry proxy used by DinD
+"""
+import sys
+from argparse import ArgumentParser, Namespace
+from typing import Callable
+
+from lib.logger import install_logger
+from lib.parser_defaults import (
+    parser_add_subparser_for_subcommands,
+    parser_default_args,
+    parser_default_funcs,
+)
+
+
+def arguments(parser: ArgumentParser):
+    """Set arguments for this command."""
+    module_name = __name__.rsplit(".", maxsplit=1)[-1]
+    parser_add_subparser_for_subcommands(parser, module_name)
+    parser.set_defaults(func=main)
+    parser_default_args(parser)
+
+
+def main(parser: Namespace, args: list):  # pylint: disable=unused-argument
+    """Main entry point for this command."""
+
+    parser_default_funcs(parser)
+    sys.exit(0)
+
+
+def subcommand_arguments(parser: ArgumentParser, main_func: Callable):
+    """Set arguments shared by all registry subcommands"""
+    parser.set_defaults(func=main_func)
+    parser_default_args(parser)
+
+
+def run_subcommand(parser: Namespace, ui_func: Callable[[], bool]):
+    """Run registry subcommand, exit code is 1 when `ui_func` fails"""
+    parser_default_funcs(parser)
+    install_logger(parser.log_level, parser.log_filename)
+    sys.exit(0 if ui_func() else 1)
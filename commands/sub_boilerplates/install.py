@@ -9,6 +9,7 @@ from re import match
 from beaupy import ValidationError, confirm, prompt, select
 from rich.console import Console
 
+from lib.boilerplates import export_boilerplates, update_boilerplates_mirror
 from lib.dekickrc import get_dekick_version
 from lib.global_config import get_global_config_value
 from lib.logger import install_logger
@@ -121,27 +122,9 @@ def download_boilerplate(boilerplate: str):
         boilerplates_git_url = get_global_config_value("boilerplates.git_url")
         dekick_version = get_dekick_version()
 
-        rbash(
-            "Download boilerplate files",
-            "git clone -n --depth 1 --filter tree:0 "
-            + f'"{boilerplates_git_url}" "{DEKICK_BOILERPLATES_INSTALL_PATH}"',
-        )
-        rbash(
-            "Apply sparse checkout",
-            f'cd "{DEKICK_BOILERPLATES_INSTALL_PATH}";'
-            + f"git sparse-checkout set --no-cone --sparse-index {boilerplate}",
-        )
-
-        if dekick_version != "develop":
-            rbash(
-                "Checkout specific boilerplate version (tag)",
-                f'cd {DEKICK_BOILERPLATES_INSTALL_PATH}";'
-                + f'git tag "{dekick_version}',
-            )
-
-        rbash(
-            "Checkout specific boilerplate version (branch)",
-            f'cd "{DEKICK_BOILERPLATES_INSTALL_PATH}"; git checkout {dekick_version}',
+        update_boilerplates_mirror(boilerplates_git_url)
+        export_boilerplates(
+            dekick_version, DEKICK_BOILERPLATES_INSTALL_PATH, boilerplate
         )
     except TypeError as exc:
         raise TypeError(
@@ -204,8 +187,6 @@ def cleanup(boilerplate: str):
         f"{DEKICK_BOILERPLATES_INSTALL_PATH}/{boilerplate}/.boilerplate.yml"
     )
 
-    rbash("Remove .git directory", f"rm -rf {DEKICK_BOILERPLATES_INSTALL_PATH}/.git")
-
     ignores = boilerplate_flat.get("install-ignore")
     if not ignores or not isinstance(ignores, list):
         raise TypeError(
@@ -8,10 +8,10 @@ from os.path import isdir
 from shutil import copyfile
 from tempfile import mkdtemp
 
+from lib.boilerplates import export_boilerplates, update_boilerplates_mirror
 from lib.dekickrc import get_dekick_version, get_dekickrc_value
 from lib.global_config import get_global_config_value
 from lib.logger import install_logger
-from lib.misc import run_shell
 from lib.parser_defaults import parser_default_args, parser_default_funcs
 from lib.run_func import run_func
 from lib.settings import C_CODE, C_END, C_FILE, DEKICKRC_GLOBAL_HOST_PATH, PROJECT_ROOT
@@ -63,49 +63,8 @@ def ui_download_boilerplate(boilerplate: str):
         boilerplates_git_url = get_global_config_value("boilerplates.git_url")
         dekick_version = get_dekick_version()
 
-        run_shell(
-            cmd=[
-                "git",
-                "clone",
-                "-n",
-                "--depth",
-                "1",
-                "--filter",
-                "tree:0",
-                boilerplates_git_url,
-                BOILERPLATES_TMP_PATH,
-            ],
-            raise_exception=True,
-            capture_output=True,
-        )
-        run_shell(
-            cmd=[
-                "git",
-                "sparse-checkout",
-                "set",
-                "--no-cone",
-                "--sparse-index",
-                boilerplate,
-            ],
-            cwd=BOILERPLATES_TMP_PATH,
-            raise_exception=True,
-            capture_output=True,
-        )
-
-        if dekick_version != "develop":
-            run_shell(
-                cmd=["git", "tag", dekick_version],
-                cwd=BOILERPLATES_TMP_PATH,
-                raise_exception=True,
-                capture_output=True,
-            )
-
-        run_shell(
-            cmd=["git", "checkout", dekick_version],
-            cwd=BOILERPLATES_TMP_PATH,
-            raise_exception=True,
-            capture_output=True,
-        )
+        update_boilerplates_mirror(boilerplates_git_url)
+        export_boilerplates(dekick_version, BOILERPLATES_TMP_PATH, boilerplate)
     except TypeError:
         return {
             "success": False,
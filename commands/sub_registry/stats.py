@@ -0,0 +1,60 @@
+"""Show Docker registry proxy cache statistics"""
+from argparse import ArgumentParser, Namespace
+
+from commands.registry import run_subcommand, subcommand_arguments
+from lib.registry import (
+    get_docker_registry_cache_size,
+    get_docker_registry_cache_stats,
+    is_docker_registry_running,
+)
+from lib.run_func import run_func
+from lib.settings import C_CODE, C_END
+
+
+def parser_help() -> str:
+    """Set description for this command, used in arguments parser"""
+    return (
+        "Shows cache hits and misses of the Docker registry proxy "
+        + "(since it was started) and size of its cache"
+    )
+
+
+def arguments(parser: ArgumentParser):
+    """Set arguments for this command."""
+    subcommand_arguments(parser, main)
+
+
+def main(parser: Namespace, args: list):  # pylint: disable=unused-argument
+    """Main entry point for this command."""
+    run_subcommand(
+        parser,
+        lambda: run_func(
+            text="Reading Docker registry proxy cache statistics",
+            func=ui_stats,
+            terminate=False,
+        ),
+    )
+
+
+def ui_stats() -> dict:
+    """UI wrapper for registry proxy cache statistics"""
+    if not is_docker_registry_running():
+        return {
+            "success": False,
+            "type": "warn",
+            "text": "Docker registry proxy is not running",
+        }
+
+    stats = get_docker_registry_cache_stats()
+    size = get_docker_registry_cache_size() or "unknown"
+    requests = stats["hits"] + stats["misses"]
+    hit_rate = round(stats["hits"] / requests * 100) if requests else 0
+
+    return {
+        "success": True,
+        "text": "Docker registry proxy cache: "
+        + f"{C_CODE}{stats['hits']}{C_END} hits, "
+        + f"{C_CODE}{stats['misses']}{C_END} misses "
+        + f"({C_CODE}{hit_rate}%{C_END} hit rate), "
+        + f"size {C_CODE}{size}{C_END}",
+    }
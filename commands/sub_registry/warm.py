@@ -0,0 +1,179 @@
+"""Pre-pull base images used by the project through the Docker registry proxy"""
+import re
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from logging import debug
+from os import walk
+from os.path import join
+
+import yaml
+
+from commands.registry import run_subcommand, subcommand_arguments
+from lib.dind import dind_container
+from lib.misc import run_shell
+from lib.run_func import run_func
+from lib.settings import C_CODE, C_END, PROJECT_ROOT
+
+DOCKERFILE_PATTERNS = ["Dockerfile", "Dockerfile.*", "*.Dockerfile"]
+COMPOSE_PATTERNS = [
+    "docker-compose*.yml",
+    "docker-compose*.yaml",
+    "compose*.yml",
+    "compose*.yaml",
+]
+SKIPPED_DIRS = [".git", "node_modules", "vendor"]
+MAX_PARALLEL_PULLS = 4
+
+
+def parser_help() -> str:
+    """Set description for this command, used in arguments parser"""
+    return (
+        "Pulls base images referenced in project's Dockerfiles and "
+        + "Docker Compose files through the Docker registry proxy"
+    )
+
+
+def arguments(parser: ArgumentParser):
+    """Set arguments for this command."""
+    subcommand_arguments(parser, main)
+
+
+def main(parser: Namespace, args: list):  # pylint: disable=unused-argument
+    """Main entry point for this command."""
+    run_subcommand(parser, ui_warm)
+
+
+def ui_warm() -> bool:
+    """UI wrapper for warming the registry proxy cache"""
+    images = get_project_images(PROJECT_ROOT)
+
+    if not images:
+        return run_func(
+            text="Warming Docker registry proxy cache",
+            func=lambda: {
+                "success": False,
+                "type": "warn",
+                "text": "No base images found in Dockerfiles or Docker Compose files",
+            },
+            terminate=False,
+        )
+
+    with dind_container(sync_project=False):
+        return run_func(
+            text=f"Pulling {C_CODE}{len(images)}{C_END} images through "
+            + "Docker registry proxy",
+            func=warm_registry_cache,
+            func_args={"images": images},
+            terminate=False,
+        )
+
+
+def warm_registry_cache(images: list) -> dict:
+    """Pull images in DinD, its Docker daemon pulls through the registry proxy"""
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PULLS) as executor:
+        results = dict(zip(images, executor.map(pull_image, images)))
+
+    failed = [image for image, pulled in results.items() if not pulled]
+    pulled_count = len(images) - len(failed)
+    text = f"Pulled {C_CODE}{pulled_count}{C_END} images through Docker registry proxy"
+
+    if failed:
+        return {
+            "success": False,
+            "type": "warn",
+            "text": text
+            + f", failed to pull {C_CODE}"
+            + f"{C_END}, {C_CODE}".join(failed)
+            + C_END,
+        }
+
+    return {"success": True, "text": text}
+
+
+def pull_image(image: str) -> bool:
+    """Pull a single image, returns False if it failed"""
+    ret = run_shell(
+        cmd=["docker", "pull", "-q", image],
+        raise_exception=False,
+        raise_error=False,
+        capture_output=True,
+    )
+    return ret["returncode"] == 0
+
+
+def get_project_images(root: str) -> list:
+    """Get images referenced by Dockerfiles and Docker Compose files in project"""
+    images = []
+
+    for file in find_files(root, DOCKERFILE_PATTERNS):
+        images += get_dockerfile_images(file)
+
+    for file in find_files(root, COMPOSE_PATTERNS):
+        images += get_compose_images(file)
+
+    return sorted(set(images))
+
+
+def find_files(root: str, patterns: list) -> list:
+    """Find files matching any of given patterns, skipping dependency directories"""
+    files = []
+
+    for dirpath, dirnames, filenames in walk(root):
+        dirnames[:] = [dirname for dirname in dirnames if dirname not in SKIPPED_DIRS]
+        for filename in filenames:
+            if any(fnmatch(filename, pattern) for pattern in patterns):
+                files.append(join(dirpath, filename))
+
+    return files
+
+
+def get_dockerfile_images(file: str) -> list:
+    """Get images from FROM instructions, skipping build stages and scratch"""
+    images = []
+    stages = {"scratch"}
+
+    with open(file, encoding="utf-8") as dockerfile:
+        for line in dockerfile:
+            match = re.match(
+                r"^\s*FROM\s+(?:--platform=\S+\s+)?(\S+)(?:\s+AS\s+(\S+))?",
+                line,
+                re.IGNORECASE,
+            )
+            if match is None:
+                continue
+
+            image, stage = match.groups()
+            if image.lower() not in stages and "$" not in image:
+                images.append(image)
+            if stage:
+                stages.add(stage.lower())
+
+    debug("Images found in %s: %s", file, images)
+    return images
+
+
+def get_compose_images(file: str) -> list:
+    """Get images of services which are not built from a Dockerfile"""
+    try:
+        with open(file, encoding="utf-8") as compose_file:
+            compose = yaml.safe_load(compose_file) or {}
+    except yaml.YAMLError:
+        debug("Unable to parse %s, skipping", file)
+        return []
+
+    services = compose.get("services") if isinstance(compose, dict) else None
+    if not isinstance(services, dict):
+        return []
+
+    images = [
+        service["image"]
+        for service in services.values()
+        if isinstance(service, dict)
+        and isinstance(service.get("image"), str)
+        and "build" not in service
+        and "$" not in service["image"]
+    ]
+
+    debug("Images found in %s: %s", file, images)
+    return images
@@ -117,8 +117,16 @@ if [ "$#" -eq 0 ] || [ "${1#-}" != "$1" ]; then
 	if [ -n "${DOCKER_TLS_CERTDIR:-}" ]; then
 		_tls_generate_certs "$DOCKER_TLS_CERTDIR"
 
-    # Get the CA cert from the proxy and install to the system
-    curl http://proxy:3128/ca.crt > /usr/share/ca-certificates/docker_registry_proxy.crt
+    # Get the CA cert from the proxy and install to the system, the proxy
+    # is started along with this container so it may not be up yet
+    proxyDeadline=$(( $(date +%s) + 60 ))
+    until curl -fsS http://proxy:3128/ca.crt -o /usr/share/ca-certificates/docker_registry_proxy.crt; do
+      if [ "$(date +%s)" -ge "$proxyDeadline" ]; then
+        echo >&2 "error: Docker registry proxy is not reachable"
+        exit 1
+      fi
+      sleep 0.1
+    done
     echo "docker_registry_proxy.crt" >> /etc/ca-certificates.conf
     update-ca-certificates --fresh
 
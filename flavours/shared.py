@@ -2,7 +2,13 @@
 Shared functions for all flavours
 """
 
+import json
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from os import getcwd
+from shlex import quote
 from subprocess import CalledProcessError
 from sys import stdout
 from typing import Union
@@ -18,10 +24,17 @@ from commands.docker_compose import (
 )
 from commands.yarn import ui_yarn
 from lib.dekickrc import get_dekickrc_value
-from lib.dind import copy_from_dind
+from lib.dind import (
+    copy_from_dind,
+    copy_image_from_dind,
+    copy_output_from_dind,
+    copy_to_dind,
+)
+from lib.dind_sync import get_context_filter_cmd
 from lib.dotenv import get_dotenv_var
+from lib.fs import chown
 from lib.logger import log_exception
-from lib.misc import create_temporary_dir, get_flavour_container, run_shell
+from lib.misc import get_flavour_container, run_shell
 from lib.run_func import run_func
 from lib.settings import (
     C_CMD,
@@ -34,6 +47,9 @@ from lib.settings import (
     is_pytest,
 )
 
+BUILDX_BUILDER = "dekick"
+BUILD_CONTEXT_TAR = "/tmp/dekick-build-context.tar"
+
 
 def composer_install():
     """Run composer install command"""
@@ -60,6 +76,8 @@ def composer_install():
                 "text": "No key APP_ENV defined in .env file",
             }
 
+        return {"success": True, "text": ""}
+
     def run_composer_install():
         try:
             composer(["install", *args])
@@ -82,13 +100,26 @@ def copy_artifacts_from_dind():
     if not is_ci() or is_pytest() or artifacts_dir is None:
         return
 
-    for artifact_dir in artifacts_dir:
-        resource = artifact_dir["path"]
-        run_func(
-            text=f"Copying {C_FILE}{resource}{C_END} from container to host",
-            func=copy_from_dind,
-            func_args={"resource": resource},
-        )
+    resources = [artifact_dir["path"] for artifact_dir in artifacts_dir]
+
+    if not resources:
+        return
+
+    def run():
+        with ThreadPoolExecutor(max_workers=min(len(resources), 4)) as executor:
+            copied = list(executor.map(copy_from_dind, resources))
+
+        skipped = [resource for resource, done in zip(resources, copied) if not done]
+        text = f"Copied {C_FILE}{', '.join(resources)}{C_END} from container to host"
+        if skipped:
+            text += f" ({C_FILE}{', '.join(skipped)}{C_END} up to date)"
+
+        return {"success": True, "text": text}
+
+    run_func(
+        text=f"Copying {C_FILE}{', '.join(resources)}{C_END} from container to host",
+        func=run,
+    )
 
 
 def yarn_build():
@@ -200,58 +231,229 @@ def wait_for_container(
     )
 
 
-def build_image(target_image: str):
-    """Build image"""
+def build_images(
+    targets: list,
+    cache_from: Union[list, None] = None,
+    cache_to: Union[list, None] = None,
+    concurrency: int = 1,
+    compression: str = "gzip",
+):
+    """Build images using files from the flavour container as build context.
+
+    Files are streamed as a tar straight from the container into `docker build`,
+    project's `docker/` directory is copied into the container first so the
+    Dockerfile is always part of the context. Files matching `.dockerignore`
+    are filtered out of the tar, so they aren't sent to the builder at all.
+    `cache_from` and `cache_to` are BuildKit cache specs, e.g.
+    `type=local,src=.cache/build` or
+    `type=registry,ref=registry.example.com/app:cache`.
+
+    Each target is a dict with `image`, `stage` and `build_args` keys, several
+    targets are built at once (up to `concurrency`) from a single context tar.
+    With `zstd` compression the context tar is kept (see `export_image`) and
+    has to be removed with `remove_build_context`.
+    """
     container = get_flavour_container()
-    tmp_dir = retrieve_files_from_container(container)
+    cache_from = cache_from or []
+    cache_to = cache_to or []
+    use_buildx = bool(cache_from or cache_to) or compression == "zstd"
+    keep_context = len(targets) > 1 or compression == "zstd"
+    images = ", ".join(f"{C_CODE}{target['image']}{C_END}" for target in targets)
 
     def run():
+        try:
+            container_id = find_image_id_by_container(container)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.error(err)
+            return {
+                "success": False,
+                "text": f"Failed to find container id for container {container}",
+            }
+
         run_shell(
-            [
-                "docker",
-                "build",
-                f"{tmp_dir}",
-                "-f",
-                "docker/Dockerfile",
-                "-t",
-                target_image,
-            ],
+            cmd=["docker", "cp", "docker/.", f"{container_id}:/usr/src/app/docker"],
             capture_output=True,
             raise_exception=True,
         )
 
+        for path in get_local_cache_paths(cache_from, "src"):
+            copy_to_dind(path)
+
+        if use_buildx:
+            create_buildx_builder()
+
+        context_cmd = f"docker cp {quote(container_id)}:/usr/src/app/. -"
+        filter_cmd = get_context_filter_cmd(getcwd())
+        if filter_cmd:
+            context_cmd += f" | {filter_cmd}"
+        if keep_context:
+            run_shell(
+                cmd=[
+                    "sh",
+                    "-c",
+                    f"set -o pipefail; {context_cmd} > {BUILD_CONTEXT_TAR}",
+                ],
+                capture_output=True,
+                raise_exception=True,
+            )
+            context_cmd = f"cat {BUILD_CONTEXT_TAR}"
+
+        def build(target: dict) -> str:
+            build_cmd = get_build_cmd(target, cache_from, cache_to, use_buildx)
+            ret = run_shell(
+                cmd=[
+                    "sh",
+                    "-c",
+                    f"set -o pipefail; {context_cmd} | "
+                    + " ".join(quote(arg) for arg in build_cmd),
+                ],
+                capture_output=True,
+                raise_exception=True,
+            )
+            return f"{C_CODE}{target['image']}{C_END}" + get_cache_summary(
+                ret["stdout"]
+            )
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+                built = list(executor.map(build, targets))
+        finally:
+            if compression != "zstd":
+                remove_build_context()
+
+        for path in get_local_cache_paths(cache_to, "dest"):
+            copy_from_dind(path)
+
+        return {
+            "success": True,
+            "text": f"Built image{'s' if len(built) > 1 else ''} " + ", ".join(built),
+        }
+
     run_func(
-        text=f"Building image {C_CODE}{target_image}{C_END} using files "
-        + f"from {C_CODE}{tmp_dir}{C_END}",
+        text=f"Building {images} using files from container {C_CODE}{container}{C_END}",
         func=run,
     )
 
 
-def retrieve_files_from_container(container: str) -> str:
-    """Retrieve files from container"""
-    tmp_dir = create_temporary_dir()
+def get_build_cmd(
+    target: dict,
+    cache_from: list,
+    cache_to: list,
+    buildx: bool = False,
+    output: str = "",
+) -> list:
+    """Get `docker build` command reading build context from stdin. With `buildx`
+    the builder using docker-container driver is used (the default one can't
+    export cache nor compress layers with zstd), the image is loaded to Docker
+    unless another `output` is given."""
+    cmd = ["docker", "build"]
+
+    if buildx:
+        cmd = ["docker", "buildx", "build", "--builder", BUILDX_BUILDER]
+        cmd += ["--output", output] if output else ["--load"]
+
+    cmd += ["--progress", "plain", "-f", "docker/Dockerfile", "-t", target["image"]]
+
+    if target.get("stage"):
+        cmd += ["--target", target["stage"]]
+    for name, value in target.get("build_args", {}).items():
+        cmd += ["--build-arg", f"{name}={value}"]
+    for spec in cache_from:
+        cmd += ["--cache-from", spec]
+    for spec in cache_to:
+        cmd += ["--cache-to", spec]
+
+    return cmd + ["-"]
+
+
+def export_image(target: dict, output: str, dest: str = ""):
+    """Build the target again with another BuildKit `output`, all steps are taken
+    from the builder's cache and context from the tar kept by `build_images`.
+    Output written to stdout (`dest=-`) is saved to host's `dest` file."""
+    build_cmd = get_build_cmd(target, [], [], buildx=True, output=output)
+    cmd = [
+        "sh",
+        "-c",
+        f"set -o pipefail; cat {BUILD_CONTEXT_TAR} | "
+        + " ".join(quote(arg) for arg in build_cmd),
+    ]
+
+    if dest:
+        copy_output_from_dind(cmd, dest)
+        return
+
+    run_shell(cmd, capture_output=True, raise_exception=True)
+
+
+def remove_build_context():
+    """Remove build context tar kept in DinD"""
+    run_shell(
+        cmd=["rm", "-f", BUILD_CONTEXT_TAR],
+        capture_output=True,
+        raise_exception=False,
+        raise_error=False,
+    )
 
-    def run():
-        try:
-            image_id = find_image_id_by_container(container)
-        except Exception as err:  # pylint: disable=broad-except
-            logging.error(err)
-            return {
-                "success": False,
-                "text": f"Failed to find image id for container {container}",
-            }
 
+def create_buildx_builder():
+    """Create buildx builder used for builds with cache if it doesn't exist yet"""
+    ret = run_shell(
+        ["docker", "buildx", "inspect", BUILDX_BUILDER],
+        capture_output=True,
+        raise_exception=False,
+        raise_error=False,
+    )
+    if ret["returncode"] != 0:
         run_shell(
-            cmd=["docker", "cp", f"{image_id}:/usr/src/app", tmp_dir],
+            [
+                "docker",
+                "buildx",
+                "create",
+                "--name",
+                BUILDX_BUILDER,
+                "--driver",
+                "docker-container",
+            ],
+            capture_output=True,
             raise_exception=True,
         )
 
-    run_func(
-        text=f"Copying files from container {C_CODE}{container}{C_END} to {C_CODE}{tmp_dir}{C_END}",
-        func=run,
-    )
 
-    return tmp_dir
+def get_local_cache_paths(specs: list, key: str) -> list:
+    """Get paths of `type=local` cache specs (`src` for import, `dest` for export)"""
+    paths = []
+
+    for spec in specs:
+        attrs = dict(attr.split("=", 1) for attr in spec.split(",") if "=" in attr)
+        if attrs.get("type") == "local" and attrs.get(key):
+            paths.append(attrs[key])
+
+    return paths
+
+
+def get_cache_summary(build_output: str) -> str:
+    """Get layer cache hit ratio from `docker build --progress plain` output"""
+    steps = set()
+    cached = set()
+
+    for line in build_output.splitlines():
+        step = re.match(r"^#(\d+) \[[^\]]*\d+/\d+\] (\w+)", line)
+        if step is not None and step.group(2).upper() != "FROM":
+            steps.add(step.group(1))
+            continue
+
+        hit = re.match(r"^#(\d+) CACHED", line)
+        if hit is not None:
+            cached.add(hit.group(1))
+
+    if not steps:
+        return ""
+
+    hits = len(steps & cached)
+    return (
+        f", {C_CODE}{hits}/{len(steps)}{C_END} layers cached "
+        + f"({round(hits / len(steps) * 100)}%)"
+    )
 
 
 def find_image_id_by_container(container: str) -> str:
@@ -262,13 +464,27 @@ def find_image_id_by_container(container: str) -> str:
     return str(ret["stdout"]).strip()
 
 
-def push_image(
-    image_name: str,
+# pylint: disable=too-many-arguments
+def push_images(
+    targets: list,
+    *,
     docker_login_user: str,
     docker_login_password: str,
     docker_registry: str,
+    concurrency: int = 1,
+    compression: str = "gzip",
 ) -> None:
-    """Push image to Docker registry"""
+    """Push images to Docker registry, up to `concurrency` at the same time.
+
+    Images the registry already has (tag points to a manifest with the same
+    config digest, i.e. the same layers and config) are skipped. Tags of the
+    same image are pushed one after another so layers are uploaded only once.
+    With `zstd` compression images are pushed by BuildKit with layers
+    compressed using zstd, then layer digests are compared instead as config
+    of such image differs by creation time.
+    """
+    images = [target["image"] for target in targets]
+    targets_by_image = {target["image"]: target for target in targets}
 
     def run():
         try:
@@ -285,88 +501,223 @@ def push_image(
                 capture_output=True,
             )
 
-            run_shell(["docker", "push", image_name], capture_output=True)
-            return {"success": True}
+            def push(tags: list) -> list:
+                pushed = []
+                for tag in tags:
+                    if is_image_pushed(tag, compression):
+                        continue
+                    if compression == "zstd":
+                        export_image(
+                            targets_by_image[tag],
+                            f"type=image,name={tag},push=true,compression=zstd,"
+                            + "force-compression=true,oci-mediatypes=true",
+                        )
+                    else:
+                        run_shell(["docker", "push", tag], capture_output=True)
+                    pushed.append(tag)
+                return pushed
+
+            with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+                pushed = list(
+                    chain.from_iterable(executor.map(push, group_images_by_id(images)))
+                )
         except Exception as error:  # pylint: disable=broad-except
             logging.error("Message or exit code: %s", error.args[0])
             log_exception(error)
             return {
                 "success": False,
-                "text": f"Failed to push image {image_name} to {docker_registry}, "
+                "text": f"Failed to push {', '.join(images)} to {docker_registry}, "
                 + f"check {C_CMD}dekick.log{C_END} for more information",
             }
 
+        skipped = [image for image in images if image not in pushed]
+        text = f"Pushed {', '.join(pushed) or 'nothing'} to {docker_registry}"
+        if skipped:
+            text += f" ({', '.join(skipped)} already up to date)"
+        return {"success": True, "text": text}
+
     run_func(
-        text=f"Pushing image {image_name} to {docker_registry}",
+        text=f"Pushing {', '.join(images)} to {docker_registry}",
         func=run,
     )
 
 
-def pull_and_build_images():
-    """Pull and build images"""
+def is_image_pushed(image: str, compression: str = "gzip") -> bool:
+    """Check if registry already has the same image under given tag"""
+    if compression == "zstd":
+        layers = get_image_layers(image)
+        return bool(layers) and get_remote_image_layers(image) == layers
 
-    def run():
-        args = [get_flavour_container()]
-        docker_compose(cmd="build", args=args, env={})
+    return get_remote_image_id(image) == get_image_id(image)
 
-    run_func(
-        text="Pulling and building images",
-        func=run,
+
+def get_image_layers(image: str) -> list:
+    """Get digests of uncompressed layers of a local image"""
+    ret = run_shell(
+        ["docker", "image", "inspect", "--format", "{{json .RootFS.Layers}}", image],
+        capture_output=True,
+    )
+    return json.loads(ret["stdout"]) or []
+
+
+def get_remote_image_layers(image: str) -> list:
+    """Get digests of uncompressed layers of the image in registry, empty if it
+    can't be read. When the tag points to an index, local platform is used."""
+    ret = run_shell(
+        [
+            "docker",
+            "buildx",
+            "imagetools",
+            "inspect",
+            "--format",
+            "{{json .Image}}",
+            image,
+        ],
+        capture_output=True,
+        raise_exception=False,
+        raise_error=False,
     )
+    try:
+        config = json.loads(ret["stdout"]) if ret["returncode"] == 0 else {}
+    except ValueError:
+        return []
+
+    if isinstance(config, dict) and "rootfs" not in config:
+        platform = get_image_platform(image)
+        config = next(
+            (value for key, value in config.items() if key.startswith(platform)), {}
+        )
 
+    if not isinstance(config, dict):
+        return []
+    return config.get("rootfs", {}).get("diff_ids", [])
 
-def save_image_to_dind(image_name: str) -> str:
-    """Save image to tar file"""
 
-    image_file = f"{image_name}.tar"
+def get_image_platform(image: str) -> str:
+    """Get os/architecture of a local image"""
+    return run_shell(
+        ["docker", "image", "inspect", "--format", "{{.Os}}/{{.Architecture}}", image],
+        capture_output=True,
+    )["stdout"].strip()
 
-    def run():
-        run_shell(["docker", "save", "-o", image_file, image_name])
 
-    run_func(
-        text=f"Saving image {C_CODE}{image_name}{C_END} to {C_FILE}{image_file}{C_END}",
-        func=run,
+def group_images_by_id(images: list) -> list:
+    """Group image tags pointing to the same local image"""
+    groups: dict = {}
+    for image in images:
+        groups.setdefault(get_image_id(image), []).append(image)
+    return list(groups.values())
+
+
+def get_image_id(image: str) -> str:
+    """Get ID (config digest) of a local image"""
+    ret = run_shell(
+        ["docker", "image", "inspect", "--format", "{{.Id}}", image],
+        capture_output=True,
     )
+    return str(ret["stdout"]).strip()
+
+
+def get_remote_image_id(image: str) -> str:
+    """Get config digest of the image in registry, empty if it can't be read.
+    When the tag points to an index, the manifest for local platform is used."""
 
-    return image_file
+    def inspect(reference: str) -> dict:
+        ret = run_shell(
+            ["docker", "buildx", "imagetools", "inspect", "--raw", reference],
+            capture_output=True,
+            raise_exception=False,
+            raise_error=False,
+        )
+        if ret["returncode"] != 0:
+            return {}
+        try:
+            return json.loads(ret["stdout"])
+        except ValueError:
+            return {}
+
+    manifest = inspect(image)
 
+    if "manifests" in manifest:
+        platform = get_image_platform(image)
+        repository = get_image_repository(image)
+        for descriptor in manifest["manifests"]:
+            descriptor_platform = descriptor.get("platform", {})
+            if (
+                f"{descriptor_platform.get('os')}/"
+                + f"{descriptor_platform.get('architecture')}"
+                == platform
+            ):
+                manifest = inspect(f"{repository}@{descriptor['digest']}")
+                break
 
-def copy_image_to_host(image_path: str):
-    """Copy image from dind container to host"""
+    return str(manifest.get("config", {}).get("digest", ""))
+
+
+def get_image_repository(image: str) -> str:
+    """Strip tag and digest from image reference"""
+    repository = image.split("@", 1)[0]
+    name_start = repository.rfind("/") + 1
+    if ":" in repository[name_start:]:
+        repository = repository[: name_start + repository[name_start:].index(":")]
+    return repository
+
+
+def pull_and_build_images():
+    """Pull and build images"""
 
     def run():
-        copy_from_dind(resource=image_path)
+        args = [get_flavour_container()]
+        docker_compose(cmd="build", args=args, env={})
 
     run_func(
-        text=f"Copying image {C_FILE}{image_path}{C_END} from container to host",
+        text="Pulling and building images",
         func=run,
     )
 
 
-def load_image_to_host(image_path: str):
-    """Load image from tar file"""
+def save_image_to_host(image_name: str):
+    """Stream image from dind container straight into host's Docker daemon"""
 
     def run():
-        run_shell(
-            ["docker", "load", "-i", image_path],
-            capture_output=True,
-            raise_exception=True,
-        )
+        if not copy_image_from_dind(image_name):
+            return {
+                "success": True,
+                "text": f"Image {C_CODE}{image_name}{C_END} is already present on host",
+            }
+
+        return {
+            "success": True,
+            "text": f"Loaded Docker image {C_CODE}{image_name}{C_END} to host",
+        }
 
     run_func(
-        text=f"Loading Docker image to host from {C_FILE}{image_path}{C_END}",
+        text=f"Loading Docker image {C_CODE}{image_name}{C_END} to host",
         func=run,
     )
 
 
-def remove_image_file(image_path: str):
-    """Remove image file"""
+def save_image_archive(target: dict):
+    """Save image as OCI archive with zstd compressed layers to project directory"""
+    archive = re.sub(r"[^A-Za-z0-9_.-]", "_", target["image"]) + ".oci.tar"
 
     def run():
-        run_shell(["rm", "-f", image_path])
+        export_image(
+            target,
+            "type=oci,dest=-,compression=zstd,force-compression=true",
+            dest=archive,
+        )
+        chown(archive)
+
+        return {
+            "success": True,
+            "text": f"Saved image {C_CODE}{target['image']}{C_END} "
+            + f"to {C_FILE}{archive}{C_END}",
+        }
 
     run_func(
-        text=f"Removing image file {C_FILE}{image_path}{C_END}",
+        text=f"Saving image {C_CODE}{target['image']}{C_END} "
+        + f"to {C_FILE}{archive}{C_END}",
         func=run,
     )
 
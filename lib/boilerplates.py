@@ -0,0 +1,89 @@
+"""Local mirror of boilerplates Git repository shared by commands and tests"""
+from logging import debug, warning
+from os import makedirs
+from os.path import dirname, exists, getmtime
+from shlex import quote
+from time import time
+
+from filelock import FileLock
+
+from lib.fs import touch
+from lib.rbash import rbash
+from lib.settings import DEKICK_PATH
+
+BOILERPLATES_MIRROR_PATH = f"{DEKICK_PATH}/tmp/boilerplates-mirror.git"
+BOILERPLATES_MIRROR_TTL = 3600
+BOILERPLATES_MIRROR_FETCHED = f"{BOILERPLATES_MIRROR_PATH}/dekick-fetched"
+
+
+def update_boilerplates_mirror(git_url: str, ttl: int = BOILERPLATES_MIRROR_TTL):
+    """Clones boilerplates into bare mirror or fetches changes when mirror is older
+    than `ttl` seconds, stale mirror is used as-is when fetching fails (offline)"""
+    makedirs(dirname(BOILERPLATES_MIRROR_PATH), exist_ok=True)
+
+    with FileLock(f"{BOILERPLATES_MIRROR_PATH}.lock"):
+        if not exists(BOILERPLATES_MIRROR_PATH):
+            ret = rbash(
+                "Cloning boilerplates mirror",
+                f"git clone --mirror {quote(git_url)} {BOILERPLATES_MIRROR_PATH}",
+            )
+            if ret["code"] != 0:
+                raise RuntimeError(
+                    f"Can't clone boilerplates from {git_url}\n{ret['stderr']}"
+                )
+            touch(BOILERPLATES_MIRROR_FETCHED)
+            return
+
+        if is_boilerplates_mirror_fresh(ttl):
+            debug("Boilerplates mirror is fresh, skipping fetch")
+            return
+
+        ret = rbash(
+            "Fetching boilerplates mirror",
+            f"git --git-dir={BOILERPLATES_MIRROR_PATH} remote set-url origin "
+            + f"{quote(git_url)} && git --git-dir={BOILERPLATES_MIRROR_PATH} "
+            + "fetch --prune --tags origin",
+        )
+        if ret["code"] != 0:
+            warning("Can't fetch boilerplates, using mirror as it is")
+            return
+
+        touch(BOILERPLATES_MIRROR_FETCHED)
+
+
+def is_boilerplates_mirror_fresh(ttl: int = BOILERPLATES_MIRROR_TTL) -> bool:
+    """Checks if mirror was fetched less than `ttl` seconds ago"""
+    if not exists(BOILERPLATES_MIRROR_FETCHED):
+        return False
+
+    return time() - getmtime(BOILERPLATES_MIRROR_FETCHED) < ttl
+
+
+def get_boilerplates_commit(ref: str) -> str:
+    """Gets commit hash of the `ref` (branch or tag) in mirror"""
+    ret = rbash(
+        f"Getting boilerplates commit of {ref}",
+        f"git --git-dir={BOILERPLATES_MIRROR_PATH} rev-parse "
+        + quote(f"{ref}^{{commit}}"),
+    )
+    if ret["code"] != 0:
+        raise RuntimeError(f"Boilerplates version {ref} does not exist")
+
+    return ret["stdout"].strip()
+
+
+def export_boilerplates(ref: str, dest: str, subtree: str = ""):
+    """Exports files of `ref` (only `subtree` directory when given) into `dest`
+    directory without creating a working copy"""
+    makedirs(dest, exist_ok=True)
+    paths = quote(subtree) if subtree else ""
+    ret = rbash(
+        f"Exporting boilerplates {ref} {subtree}".strip(),
+        "set -o pipefail; "
+        + f"git --git-dir={BOILERPLATES_MIRROR_PATH} archive {quote(ref)} {paths} "
+        + f"| tar -x -C {quote(dest)}",
+    )
+    if ret["code"] != 0:
+        raise RuntimeError(
+            f"Can't export boilerplates {ref} {subtree}\n{ret['stderr']}".strip()
+        )
@@ -0,0 +1,39 @@
+"""Encryption of data cached on disk with a key derived from user's secret"""
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from os import urandom
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+KDF_ITERATIONS = 200_000
+KDF_SALT_LENGTH = 16
+
+
+def encrypt(data: dict, secret: str) -> str:
+    """Encrypt data with a key derived from `secret`, salt is stored with it"""
+    salt = urandom(KDF_SALT_LENGTH)
+    token = Fernet(_derive_key(secret, salt)).encrypt(json.dumps(data).encode())
+    return f"{urlsafe_b64encode(salt).decode()}${token.decode()}"
+
+
+def decrypt(value: str, secret: str) -> dict:
+    """Decrypt data encrypted by `encrypt`, raises ValueError if it can't be done
+    (e.g. secret has changed)"""
+    try:
+        salt, token = value.split("$", 1)
+        data = Fernet(_derive_key(secret, urlsafe_b64decode(salt))).decrypt(
+            token.encode()
+        )
+        return json.loads(data)
+    except (InvalidToken, ValueError, TypeError) as exception:
+        raise ValueError("Can't decrypt data") from exception
+
+
+def _derive_key(secret: str, salt: bytes) -> bytes:
+    """Derive Fernet key from secret"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(), length=32, salt=salt, iterations=KDF_ITERATIONS
+    )
+    return urlsafe_b64encode(kdf.derive(secret.encode()))
@@ -1,5 +1,7 @@
 import re
 
+from humanfriendly import InvalidSize, parse_size
+
 from lib.settings import (
     DEKICK_BOILERPLATES,
     DEKICK_CREDENTIALS_DRIVERS,
@@ -49,6 +51,20 @@ def validator_rel_path(value: str) -> bool:
     return bool(pattern.match(value))
 
 
+def validator_size(value: str) -> bool:
+    """Validates if the provided string is a size, e.g. "500MB" or "1.5 GiB"."""
+    try:
+        parse_size(value)
+        return True
+    except InvalidSize:
+        return False
+
+
+def validator_compression(value: str) -> bool:
+    """Checks if the provided string is a supported image layer compression."""
+    return value in ["gzip", "zstd"]
+
+
 def validator_boilerplate(value: str) -> bool:
     """Checks if the provided string is a valid boilerplate name."""
     return value in DEKICK_BOILERPLATES
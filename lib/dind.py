@@ -1,108 +1,507 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from logging import debug, warning
+from logging import debug, info, warning
 from os import getcwd
-from os.path import exists, isdir
+from re import sub
+from secrets import token_hex
+from shutil import rmtree
+from socket import gethostname
+from tempfile import mkdtemp
+from threading import Lock
+from time import sleep, time
+from typing import Union
 
-from lib.dekickrc import get_dekick_version
+from humanfriendly import InvalidSize, parse_size
+
+from lib.dekickrc import get_dekick_version, get_dekickrc_value
+from lib.dind_sync import (
+    SYNC_MANIFEST_DIR,
+    export_from_dind,
+    stream_image_to_host,
+    stream_to_file,
+    sync_to_dind,
+)
+from lib.global_config import get_global_config_value
 from lib.rbash import rbash
 from lib.registry import start_docker_registry
 from lib.run_func import run_func
-from lib.settings import CURRENT_UID, CURRENT_USERNAME, is_pytest
+from lib.settings import (
+    C_CODE,
+    C_END,
+    CURRENT_UID,
+    CURRENT_USERNAME,
+    DEKICK_DOTENV_FILE,
+    is_dekick_dockerized,
+    is_pytest,
+)
 
 DIND_CONTAINER_ID = ""
+DIND_REGISTRY_STARTUP: Union[Future, None] = None
+DIND_POOLED = False
+DIND_POOL_PREFIX = "dekick-dind-pool"
+DIND_POOL_LABEL = "dekick.dind.pool"
+DIND_DATA_VOLUME = ""
+DIND_DATA_VOLUME_LOCK_TIMEOUT = 1800
+DIND_OWNER_LABEL = "dekick.dind.owner"
+DIND_STARTED_LABEL = "dekick.dind.started"
+DIND_DATA_VOLUME_MAX_SIZE = "20GB"
+DIND_DATA_VOLUME_STOP_TIMEOUT = 30
+DIND_ENV_DIR = ""
+DIND_ENV_FILES: dict = {}
+DIND_ENV_LOCK = Lock()
 
 
 @contextmanager
-def dind_container():
-    """Start a Docker-in-Docker container"""
+def dind_container(sync_project: bool = True):
+    """Start a Docker-in-Docker container, the project is copied into it unless
+    `sync_project` is False"""
 
     if is_pytest():
         debug("Not using DinD container in pytest mode")
         yield ""
         return
 
-    def create_dind_container():
-        global DIND_CONTAINER_ID  # pylint: disable=global-statement
-        dekick_version = get_dekick_version()
-        container_id = rbash(
+    global DIND_REGISTRY_STARTUP  # pylint: disable=global-statement
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    try:
+        DIND_REGISTRY_STARTUP = executor.submit(start_docker_registry)
+
+        if get_dind_pool_size() > 0:
+            run_func(
+                text="Acquiring DinD container from pool",
+                func=acquire_pooled_dind_container,
+            )
+        elif get_dind_data_volume():
+            run_func(
+                text="Creating DinD container with persistent layer store",
+                func=create_dind_container_with_data_volume,
+            )
+        else:
+            run_func(text="Creating DinD container", func=create_dind_container)
+
+        run_func(text="Starting Docker registry proxy", func=wait_for_registry_proxy)
+        if sync_project:
+            run_func(text="Copying project to DinD container", func=copy_to_dind)
+        yield DIND_CONTAINER_ID
+    finally:
+        executor.shutdown(wait=True)
+        DIND_REGISTRY_STARTUP = None
+        stop_dind_container()
+
+
+def create_dind_container():
+    """Create a fresh, single-use DinD container"""
+    global DIND_CONTAINER_ID  # pylint: disable=global-statement
+    DIND_CONTAINER_ID = rbash(
+        "Starting DinD container",
+        get_dind_run_cmd("--rm"),
+    )["stdout"].strip()
+    wait_for_dind(create_dind_container)
+
+
+def create_dind_container_with_data_volume():
+    """Create a DinD container using a named volume as Docker's data root.
+
+    The container is named after the volume, so Docker itself refuses to start
+    a second DinD on the same volume, concurrent runs wait for it to be freed.
+    Container left behind by a run which was killed is removed.
+    """
+    global DIND_CONTAINER_ID, DIND_DATA_VOLUME  # pylint: disable=global-statement
+    volume = get_dind_data_volume()
+    owner = gethostname() if is_dekick_dockerized() else ""
+    waited = 0
+
+    while True:
+        ret = rbash(
             "Starting DinD container",
-            f"docker run --privileged -d --rm --add-host proxy:host-gateway desmart/dekick-dind:{dekick_version}",
-        )["stdout"].strip()
-        DIND_CONTAINER_ID = container_id
-        wait_for_dind()
+            get_dind_run_cmd(
+                f'--rm --name "{volume}" -v "{volume}:/var/lib/docker" '
+                + f'--label "{DIND_OWNER_LABEL}={owner}" '
+                + f'--label "{DIND_STARTED_LABEL}={int(time())}"'
+            ),
+        )
+        if ret["code"] == 0:
+            break
+        if "is already in use" not in ret["stderr"]:
+            raise RuntimeError(f"Failed to start DinD container: {ret['stderr']}")
+        if is_dind_data_volume_lock_stale(volume):
+            warning("Removing DinD container %s left behind by another run", volume)
+            stop_dind_container_gracefully(volume)
+            rbash("Removing stale DinD container", f'docker rm -f "{volume}"')
+            continue
+        if waited >= DIND_DATA_VOLUME_LOCK_TIMEOUT:
+            raise RuntimeError(
+                f"Volume {volume} is still used by another DinD container "
+                + f"after {waited}s, remove it using docker rm -f {volume}"
+            )
+        info("Volume %s is used by another DeKick run, waiting...", volume)
+        sleep(5)
+        waited += 5
+
+    DIND_CONTAINER_ID = volume
+    DIND_DATA_VOLUME = volume
+    wait_for_dind(create_dind_container_with_data_volume)
 
-    def check_dind_docker_running() -> bool:
-        dind_container_id = get_dind_container_id()
+    if not reset_dind_container(volume):
+        raise RuntimeError(f"Failed to clean up DinD container using {volume} volume")
+
+    return {
+        "success": True,
+        "text": f"Created DinD container using {C_CODE}{volume}{C_END} as layer store",
+    }
+
+
+def is_dind_data_volume_lock_stale(volume: str) -> bool:
+    """Check if DinD container using the volume was left behind by a killed run.
+
+    DeKick's own container (recorded as the owner) is started with --rm, so if
+    it's gone the owner is dead. Without the owner (DeKick not dockerized) the
+    lock is stale after DIND_DATA_VOLUME_LOCK_TIMEOUT.
+    """
+    ret = rbash(
+        "Checking owner of DinD container",
+        "docker inspect --format "
+        + f'\'{{{{index .Config.Labels "{DIND_OWNER_LABEL}"}}}}|'
+        + f'{{{{index .Config.Labels "{DIND_STARTED_LABEL}"}}}}\' '
+        + f'"{volume}"',
+    )
+    if ret["code"] != 0:
+        return False
+
+    owner, _, started = ret["stdout"].strip().partition("|")
+    if not started.isdigit():
+        return False
+
+    if owner != "":
         ret = rbash(
-            "Waiting for DinD to start then change permissions of docker socket",
-            f'docker exec "{dind_container_id}" bash -c "while ! '
-            + "docker ps >/dev/null 2>&1; do sleep 1; done; chmod 666 /var/run/docker.sock; "
-            + f"adduser -D -h /tmp/homedir -u {CURRENT_UID} {CURRENT_USERNAME}"
-            + '"',
+            "Checking if owner of DinD container is running",
+            f'docker inspect --format "{{{{.State.Running}}}}" "{owner}"',
         )
+        return ret["code"] != 0 or ret["stdout"].strip() != "true"
+
+    return time() - int(started) > DIND_DATA_VOLUME_LOCK_TIMEOUT
+
 
-        if ret["code"] == 137:
-            return False
-        return True
+def get_dind_data_volume() -> str:
+    """Get the name of the volume used as DinD's data root, empty when disabled"""
+    scope = str(get_global_config_value("dekick.dind.data_volume", False) or "")
 
-    def wait_for_dind():
-        max_retries = 5
-        count = 1
-        while count < max_retries and not check_dind_docker_running():
-            count = count + 1
-            warning("DinD didn't start properly, retrying... %s", count)
-            create_dind_container()
+    if scope == "":
+        return ""
 
-        if count > max_retries:
-            raise Exception("DinD didn't start properly")
+    if scope == "project":
+        project_group = get_dekickrc_value("project.group")
+        project_name = get_dekickrc_value("project.name")
+        key = f"{project_group}-{project_name}"
+    elif scope == "flavour":
+        key = str(get_dekickrc_value("dekick.flavour"))
+    else:
+        warning("Invalid dekick.dind.data_volume value %s, volume disabled", scope)
+        return ""
 
+    key = sub(r"[^a-z0-9_.-]", "-", key.lower()).strip("-")
+    return f"dekick-dind-{scope}-{key}"
+
+
+def collect_dind_garbage(dind_container_id: str):
+    """Keep DinD's layer store below dekick.dind.data_volume_max_size, build
+    cache is pruned first and all unused images only if it's still too big"""
+    max_size = str(
+        get_global_config_value("dekick.dind.data_volume_max_size", False)
+        or DIND_DATA_VOLUME_MAX_SIZE
+    )
     try:
-        run_func(text="Starting Docker registry proxy", func=start_docker_registry)
-        run_func(text="Creating DinD container", func=create_dind_container)
-        run_func(text="Copying project to DinD container", func=copy_to_dind)
-        yield DIND_CONTAINER_ID
-    finally:
-        stop_dind_container()
+        max_bytes = parse_size(max_size)
+    except InvalidSize:
+        warning("Invalid dekick.dind.data_volume_max_size value %s", max_size)
+        max_bytes = parse_size(DIND_DATA_VOLUME_MAX_SIZE)
 
+    rbash(
+        "Pruning DinD build cache",
+        f'docker exec "{dind_container_id}" '
+        + f"docker builder prune -af --keep-storage {max_bytes}",
+    )
+    ret = rbash(
+        "Checking DinD layer store size",
+        f'docker exec "{dind_container_id}" du -sk /var/lib/docker',
+    )
 
-def copy_to_dind(filename: str = ""):
-    """Copy the project to the DinD container"""
-    if not is_dind_running():
+    try:
+        used_bytes = int(ret["stdout"].split()[0]) * 1024
+    except (IndexError, ValueError):
         return
 
+    if used_bytes > max_bytes:
+        rbash(
+            "Pruning unused DinD images",
+            f'docker exec "{dind_container_id}" docker image prune -af',
+        )
+
+
+def get_dind_run_cmd(args: str = "") -> str:
+    """Get the `docker run` command used to start a DinD container"""
+    dekick_version = get_dekick_version()
+    return (
+        f"docker run --privileged -d {args} --add-host proxy:host-gateway "
+        + f"desmart/dekick-dind:{dekick_version}"
+    )
+
+
+def wait_for_registry_proxy():
+    """Wait for the registry proxy started along with DinD, its Docker daemon
+    pulls through the proxy so it's not usable before the proxy is up"""
+    if DIND_REGISTRY_STARTUP is not None:
+        DIND_REGISTRY_STARTUP.result()
+
+
+def check_dind_docker_running() -> bool:
+    """Wait for the Docker daemon inside DinD and prepare it for the current user"""
+    wait_for_registry_proxy()
     dind_container_id = get_dind_container_id()
-    current_path = getcwd()
+    ret = rbash(
+        "Waiting for DinD to start then change permissions of docker socket",
+        f'docker exec "{dind_container_id}" bash -c "while ! '
+        + "docker ps >/dev/null 2>&1; do sleep 0.1; done; chmod 666 /var/run/docker.sock; "
+        + f"id -u {CURRENT_USERNAME} >/dev/null 2>&1 || "
+        + f"adduser -D -h /tmp/homedir -u {CURRENT_UID} {CURRENT_USERNAME}"
+        + '"',
+    )
+
+    if ret["code"] == 137:
+        return False
+    return True
+
+
+def wait_for_dind(create_func):
+    """Wait for DinD to start, recreate it using `create_func` if it fails"""
+    max_retries = 5
+    count = 1
+    while count < max_retries and not check_dind_docker_running():
+        count = count + 1
+        warning("DinD didn't start properly, retrying... %s", count)
+        create_func()
+
+    if count > max_retries:
+        raise Exception("DinD didn't start properly")
+
+
+def get_dind_pool_size() -> int:
+    """Get the number of warm DinD containers to keep, 0 disables the pool"""
+    pool_size = get_global_config_value("dekick.dind.pool_size", False)
+    try:
+        return max(int(pool_size or 0), 0)
+    except ValueError:
+        warning("Invalid dekick.dind.pool_size value %s, pool disabled", pool_size)
+        return 0
+
+
+def acquire_pooled_dind_container():
+    """Claim a ready DinD container from the pool or start a new pooled one.
+
+    Containers are claimed by renaming them from `-ready-` to `-busy-` which
+    is atomic in Docker, so concurrent DeKick runs never share a container.
+    """
+    global DIND_CONTAINER_ID, DIND_POOLED  # pylint: disable=global-statement
+
+    for name in get_pooled_dind_containers("ready"):
+        busy_name = name.replace("-ready-", "-busy-")
+        ret = rbash(
+            f"Claiming pooled DinD container {name}",
+            f'docker rename "{name}" "{busy_name}"',
+        )
+        if ret["code"] != 0:
+            continue
+
+        DIND_CONTAINER_ID = busy_name
+        DIND_POOLED = True
+
+        if check_dind_docker_running():
+            break
+
+        warning("Pooled DinD container %s is broken, removing it", busy_name)
+        kill_dind_container(busy_name)
+        DIND_CONTAINER_ID = ""
+        DIND_POOLED = False
+
+    if not DIND_POOLED:
+        create_pooled_dind_container()
+
+    fill_dind_pool()
+
+    return {
+        "success": True,
+        "text": f"Acquired DinD container {DIND_CONTAINER_ID} from pool",
+    }
+
+
+def create_pooled_dind_container():
+    """Start a new pooled DinD container and claim it for this run"""
+    global DIND_CONTAINER_ID, DIND_POOLED  # pylint: disable=global-statement
+    name = f"{DIND_POOL_PREFIX}-busy-{token_hex(4)}"
+    rbash("Starting pooled DinD container", get_dind_pool_run_cmd(name))
+    DIND_CONTAINER_ID = name
+    DIND_POOLED = True
+    wait_for_dind(create_pooled_dind_container)
+
+
+def get_dind_pool_run_cmd(name: str) -> str:
+    """Get the `docker run` command used to start a pooled DinD container"""
+    dekick_version = get_dekick_version()
+    return get_dind_run_cmd(
+        f'--rm --name "{name}" --label "{DIND_POOL_LABEL}={dekick_version}"'
+    )
+
+
+def get_pooled_dind_containers(state: str) -> list:
+    """Get names of pooled DinD containers (for current DeKick version) in given state"""
+    dekick_version = get_dekick_version()
+    ret = rbash(
+        f"Listing {state} pooled DinD containers",
+        "docker ps --format '{{.Names}}' "
+        + f'--filter "label={DIND_POOL_LABEL}={dekick_version}" '
+        + f'--filter "name=^{DIND_POOL_PREFIX}-{state}-"',
+    )
+    if ret["code"] != 0:
+        return []
+    return [name for name in ret["stdout"].split("\n") if name.strip() != ""]
+
+
+def fill_dind_pool():
+    """Start missing pooled DinD containers in the background.
+
+    New containers boot their Docker daemon while the current run is working,
+    readiness is checked when they are claimed.
+    """
+    missing = (
+        get_dind_pool_size()
+        - len(get_pooled_dind_containers("ready"))
+        - len(get_pooled_dind_containers("busy"))
+    )
+
+    for _ in range(missing):
+        name = f"{DIND_POOL_PREFIX}-ready-{token_hex(4)}"
+        rbash("Starting pooled DinD container", get_dind_pool_run_cmd(name))
+
+
+def release_pooled_dind_container():
+    """Reset the claimed DinD container and put it back to the pool"""
+    global DIND_POOLED  # pylint: disable=global-statement
+
+    busy_name = get_dind_container_id()
+    ready_name = busy_name.replace("-busy-", "-ready-")
+    DIND_POOLED = False
+
+    if len(get_pooled_dind_containers("ready")) >= get_dind_pool_size():
+        kill_dind_container(busy_name)
+        return
+
+    if not reset_dind_container(busy_name):
+        warning("Failed to reset pooled DinD container %s, removing it", busy_name)
+        kill_dind_container(busy_name)
+        return
+
     rbash(
-        "Create project path",
-        f'docker exec {dind_container_id} mkdir -p "{current_path}"',
+        "Returning DinD container to pool",
+        f'docker rename "{busy_name}" "{ready_name}"',
+    )
+
+
+def reset_dind_container(dind_container_id: str) -> bool:
+    """Remove containers, volumes, networks, project files and user's home
+    (registry credentials) from DinD. Images and build cache are kept."""
+    current_path = getcwd()
+    ret = rbash(
+        "Resetting DinD container",
+        f'docker exec "{dind_container_id}" sh -c "'
+        + "docker ps -aq | xargs -r docker rm -f; "
+        + "docker volume ls -q | xargs -r docker volume rm -f; "
+        + "docker network prune -f; "
+        + f"rm -rf '{current_path}' {SYNC_MANIFEST_DIR} "
+        + "/root/.docker /tmp/homedir/* /tmp/homedir/.[!.]*"
+        + '"',
     )
-    filename = filename or "."
+    return ret["code"] == 0
+
+
+def kill_dind_container(dind_container_id: str):
+    """Kill the DinD container"""
     rbash(
-        "Copying project to DinD container",
-        f'docker cp -aq "{current_path}/{filename}" "{dind_container_id}:{current_path}"',
+        "Stopping DinD container",
+        f'docker kill "{dind_container_id}"; exit 0',
     )
+
+
+def stop_dind_container_gracefully(dind_container_id: str):
+    """Stop the DinD container letting dockerd flush its state, used when
+    /var/lib/docker is a persistent volume reused by the next run"""
     rbash(
-        "Changing permissions",
-        f'docker exec {dind_container_id} chmod -R oug+rw "{current_path}"',
+        "Stopping DinD container",
+        f'docker stop -t {DIND_DATA_VOLUME_STOP_TIMEOUT} "{dind_container_id}"; '
+        + "exit 0",
     )
 
 
-def copy_from_dind(resource: str):
-    """Copy the project files (artifacts) from the DinD container back to host"""
+def copy_to_dind(filename: str = ""):
+    """Sync the project (or a single file) to the DinD container"""
+    if not is_dind_running():
+        return {"success": True, "text": "DinD container is not running, skipped"}
+
+    stats = sync_to_dind(
+        container_id=get_dind_container_id(),
+        path=getcwd(),
+        exclude=get_dekickrc_value("dekick.sync.exclude") or [],
+        include=get_sync_includes(),
+        only=[filename] if filename else None,
+    )
+
+    return {
+        "success": True,
+        "text": f"Copied {stats['sent']} changed files to DinD container "
+        + f"({stats['unchanged']} unchanged, {stats['deleted']} removed)",
+    }
+
+
+def get_sync_includes() -> list:
+    """Paths always synced to DinD even if ignored by .gitignore/.dockerignore"""
+    artifacts = get_dekickrc_value("project.artifacts") or []
+    return [DEKICK_DOTENV_FILE] + [artifact["path"] for artifact in artifacts]
+
+
+def copy_from_dind(resource: str) -> bool:
+    """Copy the project files (artifacts) from the DinD container back to host,
+    returns False when the resource was skipped because host copy is up to date"""
 
     if not is_dind_running():
-        return
+        return False
 
-    dind_container_id = get_dind_container_id()
-    current_path = getcwd()
-    full_path = f"{current_path}/{resource}"
+    return export_from_dind(
+        container_id=get_dind_container_id(),
+        path=getcwd(),
+        resource=resource,
+    )
 
-    if exists(full_path) and isdir(full_path):
-        full_path = full_path + "/."
 
-    rbash(
-        f"Copying {full_path} from dind container {dind_container_id} to host",
-        f'docker cp -aq "{dind_container_id}:{full_path}" "{full_path}"',
+def copy_output_from_dind(cmd: list, dest: str):
+    """Run a command in the DinD container saving its (binary) stdout to host file"""
+    stream_to_file(
+        container_id=get_dind_container_id(),
+        cmd=cmd,
+        dest=dest,
+        user=CURRENT_UID,
+        workdir=getcwd(),
+    )
+
+
+def copy_image_from_dind(image_name: str) -> bool:
+    """Load the image built in DinD into host's Docker daemon,
+    returns False when host already has the same image"""
+
+    if not is_dind_running():
+        return False
+
+    return stream_image_to_host(
+        container_id=get_dind_container_id(), image_name=image_name
     )
 
 
@@ -111,20 +510,65 @@ def stop_dind_container():
     if not is_dind_running():
         return
 
-    global DIND_CONTAINER_ID  # pylint: disable=global-statement
+    global DIND_CONTAINER_ID, DIND_DATA_VOLUME  # pylint: disable=global-statement
 
     if DIND_CONTAINER_ID == "":
         debug("DinD container is not running")
         return
 
-    dind_container_id = get_dind_container_id()
-    rbash(
-        "Stopping DinD container",
-        f'docker kill "{dind_container_id}"; exit 0',
-    )
+    if DIND_POOLED:
+        release_pooled_dind_container()
+    else:
+        if DIND_DATA_VOLUME:
+            collect_dind_garbage(get_dind_container_id())
+            DIND_DATA_VOLUME = ""
+            stop_dind_container_gracefully(get_dind_container_id())
+        else:
+            kill_dind_container(get_dind_container_id())
+
+    remove_dind_env_files()
     DIND_CONTAINER_ID = ""
 
 
+def get_dind_env_args(env: dict) -> list:
+    """Get `docker exec` arguments passing given environment to the DinD container.
+    The environment is written to an env file once per distinct environment and
+    reused afterwards, values spanning multiple lines are passed with `-e`"""
+    global DIND_ENV_DIR  # pylint: disable=global-statement
+
+    key = tuple(env.items())
+
+    with DIND_ENV_LOCK:
+        if key not in DIND_ENV_FILES:
+            if DIND_ENV_DIR == "":
+                DIND_ENV_DIR = mkdtemp(prefix="dekick-dind-env-")
+
+            env_file = f"{DIND_ENV_DIR}/{len(DIND_ENV_FILES)}.env"
+            multiline_args = []
+
+            with open(env_file, "w", encoding="utf-8") as file:
+                for name, value in key:
+                    if "\n" in str(value):
+                        multiline_args += ["-e", f"{name}={value}"]
+                    else:
+                        file.write(f"{name}={value}\n")
+
+            DIND_ENV_FILES[key] = ["--env-file", env_file, *multiline_args]
+
+        return DIND_ENV_FILES[key]
+
+
+def remove_dind_env_files():
+    """Remove env files created for the DinD container"""
+    global DIND_ENV_DIR  # pylint: disable=global-statement
+
+    if DIND_ENV_DIR != "":
+        rmtree(DIND_ENV_DIR, ignore_errors=True)
+
+    DIND_ENV_DIR = ""
+    DIND_ENV_FILES.clear()
+
+
 def get_dind_container_id() -> str:
     """Get the ID of the DinD container"""
     return DIND_CONTAINER_ID
@@ -0,0 +1,496 @@
+"""Tar stream based file transfer between host and DinD container"""
+
+import json
+import re
+import sys
+import tarfile
+from hashlib import sha1
+from logging import debug, info
+from os import lstat, scandir
+from os.path import exists, join, lexists
+from shlex import quote
+from shutil import which
+from stat import S_ISDIR
+from subprocess import PIPE, Popen, run
+from tempfile import TemporaryFile
+from typing import Union
+
+SYNC_MANIFEST_DIR = "/tmp/dekick-sync"
+SYNC_IGNORE_FILES = {".dockerignore": True, ".gitignore": False}
+
+
+def sync_to_dind(
+    container_id: str,
+    path: str,
+    exclude: Union[list, None] = None,
+    include: Union[list, None] = None,
+    only: Union[list, None] = None,
+) -> dict:
+    """Sync `path` from host into the DinD container, only changed files are sent.
+
+    Args:
+        container_id (str): DinD container ID or name
+        path (str): absolute path of the project, the same path is used inside DinD
+        exclude (list, optional): additional .gitignore-style patterns to skip
+        include (list, optional): paths always synced even if ignored
+        only (list, optional): sync only these paths (ignore rules are not applied)
+
+    Returns:
+        dict: ["sent": int, "deleted": int, "unchanged": int]
+    """
+    manifest_path = get_manifest_path(path)
+    remote_manifest = _read_remote_manifest(container_id, manifest_path)
+
+    if only:
+        local_manifest = dict(remote_manifest)
+        for item in only:
+            local_manifest.update(_scan_only(path, item.strip("/")))
+    else:
+        rules = _read_ignore_rules(path) + [
+            _compile_rule(pattern, anchored=False) for pattern in exclude or []
+        ]
+        includes = [item.strip("/") for item in include or [] if item.strip("/")]
+        local_manifest = _scan(path, rules, includes)
+
+    changed = [
+        name
+        for name, entry in local_manifest.items()
+        if remote_manifest.get(name) != entry
+    ]
+    deleted = [name for name in remote_manifest if name not in local_manifest]
+
+    debug("Sync to DinD: %s changed, %s deleted", len(changed), len(deleted))
+
+    _run_in_dind(container_id, ["mkdir", "-p", path])
+
+    if deleted:
+        _run_in_dind(
+            container_id,
+            ["sh", "-c", f"cd '{path}' && xargs -0 rm -rf --"],
+            stdin="\0".join(sorted(deleted, reverse=True)).encode("utf-8"),
+        )
+
+    if changed:
+        _send_tar(container_id, path, changed)
+
+    _run_in_dind(
+        container_id,
+        ["sh", "-c", f"mkdir -p {SYNC_MANIFEST_DIR} && cat > '{manifest_path}'"],
+        stdin=json.dumps(local_manifest).encode("utf-8"),
+    )
+
+    stats = {
+        "sent": len(changed),
+        "deleted": len(deleted),
+        "unchanged": len(local_manifest) - len(changed),
+    }
+    info("Sync to DinD finished: %s", stats)
+
+    return stats
+
+
+def get_manifest_path(path: str) -> str:
+    """Get the path of the sync manifest inside DinD for given project path"""
+    return f"{SYNC_MANIFEST_DIR}/{sha1(path.encode('utf-8')).hexdigest()}.json"
+
+
+def _read_remote_manifest(container_id: str, manifest_path: str) -> dict:
+    """Read the manifest of the previous sync from DinD"""
+    ret = run(
+        ["docker", "exec", container_id, "cat", manifest_path],
+        capture_output=True,
+        check=False,
+    )
+    if ret.returncode != 0:
+        return {}
+
+    try:
+        return {
+            name: list(entry) for name, entry in json.loads(ret.stdout).items()
+        }
+    except ValueError:
+        return {}
+
+
+def _manifest_entry(stat_result) -> list:
+    """Manifest entry for a file, tar stores mtime with seconds resolution"""
+    return [int(stat_result.st_mtime), stat_result.st_size, stat_result.st_mode]
+
+
+def _scan(path: str, rules: list, includes: list) -> dict:
+    """Walk the project and build a manifest of files that should be synced"""
+    manifest = {}
+
+    def is_forced(name: str) -> bool:
+        return any(name == item or name.startswith(item + "/") for item in includes)
+
+    def leads_to_forced(name: str) -> bool:
+        return any(item.startswith(name + "/") for item in includes)
+
+    def walk(directory: str, prefix: str, parent_ignored: bool):
+        with scandir(directory) as entries:
+            for entry in sorted(entries, key=lambda item: item.name):
+                name = f"{prefix}{entry.name}"
+                is_dir = entry.is_dir(follow_symlinks=False)
+                forced = is_forced(name)
+                ignored = parent_ignored or _is_ignored(rules, name, is_dir)
+
+                if ignored and not forced and not (is_dir and leads_to_forced(name)):
+                    continue
+
+                manifest[name] = _manifest_entry(entry.stat(follow_symlinks=False))
+
+                if is_dir:
+                    walk(entry.path, f"{name}/", ignored and not forced)
+
+    walk(path, "", False)
+
+    return manifest
+
+
+def _scan_only(path: str, name: str) -> dict:
+    """Build a manifest for a single file or directory, ignore rules are not applied"""
+    full_path = join(path, name)
+    if not exists(full_path):
+        return {}
+
+    manifest = {}
+    parts = name.split("/")
+    for index in range(1, len(parts)):
+        parent = "/".join(parts[:index])
+        manifest[parent] = _manifest_entry(lstat(join(path, parent)))
+
+    stat_result = lstat(full_path)
+    manifest[name] = _manifest_entry(stat_result)
+
+    if S_ISDIR(stat_result.st_mode):
+        for sub_name, entry in _scan(full_path, [], []).items():
+            manifest[f"{name}/{sub_name}"] = entry
+
+    return manifest
+
+
+def _send_tar(container_id: str, path: str, names: list):
+    """Stream given files as a tar archive into DinD, modes are set in tar headers.
+    Errors go to a temporary file, a full stderr pipe would block the transfer."""
+    with TemporaryFile() as errors, Popen(
+        ["docker", "exec", "-i", container_id, "tar", "-x", "-C", path],
+        stdin=PIPE,
+        stderr=errors,
+    ) as proc:
+        with tarfile.open(
+            fileobj=proc.stdin, mode="w|", format=tarfile.GNU_FORMAT
+        ) as tar:
+            for name in names:
+                full_path = join(path, name)
+                if not lexists(full_path):
+                    continue
+                tarinfo = tar.gettarinfo(full_path, arcname=name)
+                tarinfo.mode |= 0o666
+                if tarinfo.isreg():
+                    with open(full_path, "rb") as file:
+                        tar.addfile(tarinfo, file)
+                else:
+                    tar.addfile(tarinfo)
+        proc.stdin.close()
+        proc.wait()
+        errors.seek(0)
+        stderr = errors.read().decode("utf-8")
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"Failed to sync project to DinD container: {stderr}")
+
+
+def _run_in_dind(container_id: str, cmd: list, stdin: Union[bytes, None] = None):
+    """Run a command inside DinD as root, raise when it fails"""
+    interactive = ["-i"] if stdin is not None else []
+    ret = run(
+        ["docker", "exec", *interactive, container_id, *cmd],
+        input=stdin,
+        capture_output=True,
+        check=False,
+    )
+    if ret.returncode != 0:
+        raise RuntimeError(
+            f"Command {' '.join(cmd)} failed in DinD: {ret.stderr.decode('utf-8')}"
+        )
+
+
+def _read_ignore_rules(path: str) -> list:
+    """Read .dockerignore and .gitignore rules from the project root"""
+    rules = []
+    for ignore_file, anchored in SYNC_IGNORE_FILES.items():
+        rules += _read_ignore_file(join(path, ignore_file), anchored)
+    return rules
+
+
+def _read_ignore_file(ignore_path: str, anchored: bool) -> list:
+    """Read and compile rules of a single ignore file, empty if it doesn't exist"""
+    if not exists(ignore_path):
+        return []
+
+    rules = []
+    with open(ignore_path, encoding="utf-8") as file:
+        for line in file.read().splitlines():
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            rules.append(_compile_rule(line, anchored))
+    return rules
+
+
+def _compile_rule(pattern: str, anchored: bool) -> tuple:
+    """Compile .gitignore-style pattern to (regex, negate, dir_only)"""
+    negate = pattern.startswith("!")
+    pattern = pattern[1:] if negate else pattern
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = anchored or "/" in pattern
+    pattern = pattern.lstrip("/")
+
+    regex = ""
+    index = 0
+    while index < len(pattern):
+        if pattern[index : index + 3] == "**/":
+            regex += "(?:.*/)?"
+            index += 3
+        elif pattern[index : index + 2] == "**":
+            regex += ".*"
+            index += 2
+        elif pattern[index] == "*":
+            regex += "[^/]*"
+            index += 1
+        elif pattern[index] == "?":
+            regex += "[^/]"
+            index += 1
+        elif pattern[index] == "[" and "]" in pattern[index + 1 :]:
+            end = pattern.index("]", index + 1)
+            regex += "[" + pattern[index + 1 : end].replace("!", "^", 1) + "]"
+            index = end + 1
+        else:
+            regex += re.escape(pattern[index])
+            index += 1
+
+    prefix = "" if anchored else "(?:.*/)?"
+    return (re.compile(f"^{prefix}{regex}$"), negate, dir_only)
+
+
+def _is_ignored(rules: list, name: str, is_dir: bool) -> bool:
+    """Check if path is ignored, the last matching rule wins"""
+    ignored = False
+    for regex, negate, dir_only in rules:
+        if dir_only and not is_dir:
+            continue
+        if regex.match(name):
+            ignored = not negate
+    return ignored
+
+
+CONTEXT_FILTER_SCRIPT = """
+import json, re, sys, tarfile
+rules = [(re.compile(regex), negate, dir_only) for regex, negate, dir_only
+         in json.loads(sys.argv[1])]
+kept = {"Dockerfile", ".dockerignore", "docker/Dockerfile"}
+def is_ignored(name, is_dir):
+    ignored = False
+    for regex, negate, dir_only in rules:
+        if (is_dir or not dir_only) and regex.match(name):
+            ignored = not negate
+    return ignored
+ignored_dirs = set()
+src = tarfile.open(fileobj=sys.stdin.buffer, mode="r|")
+dst = tarfile.open(fileobj=sys.stdout.buffer, mode="w|", format=tarfile.PAX_FORMAT)
+for member in src:
+    name = member.name
+    while name.startswith("./"):
+        name = name[2:]
+    name = name.rstrip("/")
+    if name not in ("", ".") and name not in kept:
+        parts = name.split("/")
+        parents = ("/".join(parts[:index]) for index in range(1, len(parts)))
+        if any(parent in ignored_dirs for parent in parents) or is_ignored(
+            name, member.isdir()
+        ):
+            if member.isdir():
+                ignored_dirs.add(name)
+            continue
+    dst.addfile(member, src.extractfile(member) if member.isreg() else None)
+dst.close()
+src.close()
+"""
+
+
+def get_context_filter_cmd(path: str) -> str:
+    """Get shell command filtering a build context tar (stdin to stdout) with
+    rules from .dockerignore of the project, empty if there's nothing to filter.
+    Files inside ignored directories are dropped as well, as in `sync_to_dind`."""
+    rules = _read_ignore_file(join(path, ".dockerignore"), True)
+    if not rules:
+        return ""
+
+    serialized = [[rule[0].pattern, *rule[1:]] for rule in rules]
+    return f"python3 -c {quote(CONTEXT_FILTER_SCRIPT)} {quote(json.dumps(serialized))}"
+
+
+TREE_DIGEST_SCRIPT = """
+import hashlib, os, sys
+root, resource = sys.argv[1], sys.argv[2].rstrip("/")
+top = os.path.join(root, resource)
+if not os.path.lexists(top):
+    sys.exit(0)
+digest = hashlib.sha256()
+def add(path):
+    stat = os.lstat(path)
+    name = os.path.relpath(path, root)
+    target = os.readlink(path) if os.path.islink(path) else ""
+    size = 0 if os.path.isdir(path) and not target else stat.st_size
+    mtime = 0 if os.path.isdir(path) and not target else int(stat.st_mtime)
+    digest.update(f"{name}\\0{size}\\0{mtime}\\0{target}\\n".encode("utf-8", "surrogateescape"))
+add(top)
+for directory, dirs, files in os.walk(top):
+    dirs.sort()
+    for name in sorted(dirs + files):
+        add(os.path.join(directory, name))
+print(digest.hexdigest())
+"""
+
+
+def export_from_dind(container_id: str, path: str, resource: str) -> bool:
+    """Stream `resource` (relative to `path`) from DinD to the same path on host
+    as a compressed tar. Nothing is transferred when the file tree (names, sizes
+    and modification times) on host is the same as in DinD.
+
+    Returns:
+        bool: True if the resource was copied, False if skipped
+    """
+    remote_digest = _tree_digest(
+        ["docker", "exec", container_id, "python3"], path, resource
+    )
+
+    if remote_digest == "":
+        info("Resource %s does not exist in DinD, skipping", resource)
+        return False
+
+    if remote_digest == _tree_digest([sys.executable], path, resource):
+        info("Resource %s on host is up to date, skipping", resource)
+        return False
+
+    compression = get_export_compression(container_id)
+    compress_cmd = "zstd -1 -T0 -q -c" if compression == "zstd" else "gzip -1 -c"
+
+    with Popen(
+        [
+            "docker",
+            "exec",
+            container_id,
+            "sh",
+            "-c",
+            f"tar -C '{path}' -cf - '{resource}' | {compress_cmd}",
+        ],
+        stdout=PIPE,
+    ) as proc:
+        if compression == "zstd":
+            with Popen(
+                ["zstd", "-d", "-c", "-q"], stdin=proc.stdout, stdout=PIPE
+            ) as decompress:
+                proc.stdout.close()
+                _extract_tar_stream(decompress.stdout, path, "r|")
+
+            if decompress.returncode != 0:
+                raise RuntimeError(f"Failed to decompress {resource} from DinD")
+        else:
+            _extract_tar_stream(proc.stdout, path, "r|gz")
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"Failed to export {resource} from DinD container")
+
+    return True
+
+
+def get_export_compression(container_id: str) -> str:
+    """Use zstd when it's available both in DinD and on host, gzip otherwise"""
+    if which("zstd") is None:
+        return "gzip"
+
+    ret = run(
+        ["docker", "exec", container_id, "sh", "-c", "command -v zstd"],
+        capture_output=True,
+        check=False,
+    )
+    return "zstd" if ret.returncode == 0 else "gzip"
+
+
+def _tree_digest(python_cmd: list, path: str, resource: str) -> str:
+    """Digest of file names, sizes and mtimes of `resource`, empty if it doesn't exist"""
+    ret = run(
+        python_cmd + ["-c", TREE_DIGEST_SCRIPT, path, resource],
+        capture_output=True,
+        check=False,
+    )
+    if ret.returncode != 0:
+        debug("Tree digest failed: %s", ret.stderr.decode("utf-8"))
+        return ""
+    return ret.stdout.decode("utf-8").strip()
+
+
+def _extract_tar_stream(stream, path: str, mode: str):
+    """Extract tar stream into `path`, members pointing outside of it are refused"""
+    with tarfile.open(fileobj=stream, mode=mode) as tar:
+        tar.extractall(path, filter="data")
+
+
+def stream_image_to_host(container_id: str, image_name: str) -> bool:
+    """Pipe `docker save` from DinD straight into `docker load` of host's daemon,
+    nothing is written to disk on the way. Transfer is skipped when host already
+    has an image with the same ID.
+
+    Returns:
+        bool: True if the image was transferred, False if skipped
+    """
+    inspect_cmd = ["docker", "image", "inspect", "-f", "{{.Id}}", image_name]
+    remote_id = run(
+        ["docker", "exec", container_id, *inspect_cmd],
+        capture_output=True,
+        check=False,
+    )
+    if remote_id.returncode != 0:
+        raise RuntimeError(f"Image {image_name} not found in DinD container")
+
+    local_id = run(inspect_cmd, capture_output=True, check=False)
+    if local_id.returncode == 0 and local_id.stdout == remote_id.stdout:
+        info("Image %s is already present on host, skipping", image_name)
+        return False
+
+    with Popen(
+        ["docker", "exec", container_id, "docker", "save", image_name], stdout=PIPE
+    ) as save:
+        with Popen(
+            ["docker", "load"], stdin=save.stdout, stdout=PIPE, stderr=PIPE
+        ) as load:
+            save.stdout.close()
+            stdout, stderr = load.communicate()
+
+    if save.returncode != 0 or load.returncode != 0:
+        raise RuntimeError(
+            f"Failed to transfer image {image_name} to host: {stderr.decode('utf-8')}"
+        )
+
+    debug("docker load: %s", stdout.decode("utf-8").strip())
+
+    return True
+
+
+def stream_to_file(container_id: str, cmd: list, dest: str, user: str, workdir: str):
+    """Run a command inside DinD writing its stdout straight into a host file"""
+    with open(dest, "wb") as file:
+        with Popen(
+            ["docker", "exec", "--user", user, "-w", workdir, container_id, *cmd],
+            stdout=file,
+            stderr=PIPE,
+        ) as proc:
+            _, stderr = proc.communicate()
+
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"Command {' '.join(cmd)} failed in DinD: {stderr.decode('utf-8')}"
+        )
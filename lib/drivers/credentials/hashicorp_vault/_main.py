@@ -2,29 +2,37 @@ import hashlib
 import random
 import re
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from logging import debug
 from os import mkdir
 from os.path import isfile
 from shutil import copyfile
-from time import sleep
+from time import time
 
 import hvac
 from beaupy import prompt, select
 from beaupy._internals import ValidationError as BeaupyValidationError
 from genericpath import exists, isdir
 from hvac import exceptions as hvac_exceptions
+from hvac.adapters import JSONAdapter
 from requests.exceptions import ConnectionError as RequestConnectionError
 from rich.console import Console
 from rich.prompt import Confirm
 from rich.table import Table
 
+from lib.crypto import decrypt, encrypt
 from lib.dekickrc import get_dekickrc_value
 from lib.dotenv import dict2env, env2dict
 from lib.environments import get_environments
 from lib.git import is_git_repository
-from lib.global_config import get_global_config_value
-from lib.hvac import get_all_user_data, get_mount_point, get_user_policies
-from lib.logger import get_log_level
+from lib.global_config import get_global_config_value, set_global_config_value
+from lib.hvac import (
+    HVAC_MAX_WORKERS,
+    create_session,
+    get_all_user_data,
+    get_mount_point,
+    get_user_policies,
+)
 from lib.misc import run_shell
 from lib.settings import (
     C_BOLD,
@@ -53,6 +61,12 @@ DEKICK_HVAC_ROLES = ["developer", "maintainer"]
 DEKICK_HVAC_PAGE_SIZE = 20
 DEKICKRC_GITLAB_VAULT_TOKEN_VAR_NAME = "VAULT_TOKEN"
 MAINTAINER_CACHE = None
+HVAC_TOKEN = {"expires": None, "creation_ttl": 0, "renewable": False, "cached": False}
+HVAC_TOKEN_RENEW_RATIO = 0.5
+HVAC_TOKEN_CACHE_KEY = "hashicorp_vault.token_cache"
+HVAC_TOKEN_CACHE_MIN_TTL = 300
+HVAC_SECRETS_CACHE_KEY = "hashicorp_vault.secrets_cache"
+HVAC_SECRETS_CACHE_ENVS = ["local"]
 
 
 def arguments(sub_command: str, parser: ArgumentParser):
@@ -99,26 +113,32 @@ def configure():
 
 # pylint: disable=unused-argument
 def get_envs(*args, env: str, token: str = "", **kwargs) -> str:
-    """Get variables"""
-    client = _get_client(token)
+    """Get variables, `local` ones are served from local cache when the secret's id
+    hasn't changed"""
     mount_point = get_mount_point()
     project_name = str(get_dekickrc_value("project.name"))
     project_group = str(get_dekickrc_value("project.group"))
     env_data = read_yaml(DEKICK_HVAC_ENV_FILE, True)["environments"]
 
-    id = next((e["id"] for e in env_data if e["name"] == env), None)
+    secret_id = next((e["id"] for e in env_data if e["name"] == env), None)
 
-    if not id:
+    if not secret_id:
         raise ValueError(
             f"I can't get env variables because field {C_CMD}id{C_END} for environment {C_CODE}{env}{C_END} is empty in {C_FILE}{DEKICK_HVAC_ENV_FILE}{C_END} file."
         )
 
-    path = f"{project_group}/{project_name}/{env}/{id}"
+    use_cache = not token and env in HVAC_SECRETS_CACHE_ENVS
+    cached_envs = _load_cached_secret(env, secret_id) if use_cache else None
+    if cached_envs is not None:
+        return cached_envs
+
+    client = _get_client(token)
+    path = f"{project_group}/{project_name}/{env}/{secret_id}"
     try:
         secrets = client.secrets.kv.v2.read_secret_version(
             path=path, mount_point=mount_point
         )
-        return dict2env(secrets["data"]["data"], env)
+        envs = dict2env(secrets["data"]["data"], env)
     except hvac_exceptions.InvalidPath as exception:
         raise ValueError(
             f"Path {mount_point}{path} not found, check your mount_point or initialize Vault with {C_CODE}dekick credentials run init{C_END} command"
@@ -128,6 +148,11 @@ def get_envs(*args, env: str, token: str = "", **kwargs) -> str:
             f"You don't have access to path {mount_point}{path}. Do you have proper access rights?"
         ) from exception
 
+    if use_cache:
+        _save_cached_secret(env, secret_id, envs)
+
+    return envs
+
 
 def ui_pull(root_token: str = "") -> bool:
     """Pull all environment variables and save to envs/ dir for further processing"""
@@ -172,6 +197,7 @@ def ui_pull(root_token: str = "") -> bool:
 
     environments = yaml_flat["environments"]
     create_envs_dir()
+    to_pull = []
 
     for env in environments:
         env_name = env.get("name")
@@ -199,19 +225,26 @@ def ui_pull(root_token: str = "") -> bool:
                 print(f"  Skipping {C_FILE}{DEKICK_ENVS_DIR}/{env_name}.env{C_END}")
                 continue
 
-        if env_id == "":
-            envs_content = dict2env({}, env_name)
-            if _is_maintainer() or env_name != "production":
-                print(
-                    f"{C_WARN}Warning:{C_END} Creating initial, empty {C_FILE}{DEKICK_ENVS_DIR}/{env_name}.env{C_END} file."
-                )
-        else:
-            envs_content = get_envs(env=env_name, id=env_id)
+        to_pull.append((env_name, env_id))
 
-        if _is_maintainer() or env_name != "production":
-            env_file = f"{DEKICK_ENVS_DIR}/{env_name}.env"
-            with open(env_file, "w", encoding="utf-8") as file:
-                file.write(envs_content)
+    with ThreadPoolExecutor(max_workers=HVAC_MAX_WORKERS) as executor:
+        envs_contents = executor.map(
+            lambda env: get_envs(env=env[0], id=env[1]) if env[1] != "" else None,
+            to_pull,
+        )
+
+        for (env_name, env_id), envs_content in zip(to_pull, envs_contents):
+            if env_id == "":
+                envs_content = dict2env({}, env_name)
+                if _is_maintainer() or env_name != "production":
+                    print(
+                        f"{C_WARN}Warning:{C_END} Creating initial, empty {C_FILE}{DEKICK_ENVS_DIR}/{env_name}.env{C_END} file."
+                    )
+
+            if _is_maintainer() or env_name != "production":
+                env_file = f"{DEKICK_ENVS_DIR}/{env_name}.env"
+                with open(env_file, "w", encoding="utf-8") as file:
+                    file.write(envs_content)
 
     print(
         f"\nAll environment files pulled and placed in {C_FILE}{DEKICK_ENVS_DIR}/{C_END}{C_WARN} directory.{C_END}"
@@ -249,7 +282,6 @@ def ui_push(root_token: str = "", no_confirm: bool = False) -> bool:
             print(f"Creating file {C_FILE}{env_file}{C_END}")
             with open(env_file, "w", encoding="utf-8") as file:
                 file.write(dict2env({}, env_name))
-            sleep(1)
 
         if isfile(".env") and ask(
             f"Would you like to copy your local .env file to {C_FILE}{DEKICK_ENVS_DIR}/local.env{C_END}?"
@@ -275,6 +307,15 @@ def ui_push(root_token: str = "", no_confirm: bool = False) -> bool:
         ):
             return True
 
+        stage = is_git_repository() and ask(
+            f"\nDo you want to stage {C_FILE}{DEKICK_HVAC_ENV_FILE}{C_END} file after pushing?",
+            default=False,
+        )
+        stored_ids = {
+            value["name"]: value.get("id", "") for value in yaml_flat["environments"]
+        }
+        to_push = []
+
         print(f"{C_BOLD}\nPushing environment files to {info()}{C_END}")
         for env_name in environments:
             env_file = f"{DEKICK_ENVS_DIR}/{env_name}.env"
@@ -300,21 +341,29 @@ def ui_push(root_token: str = "", no_confirm: bool = False) -> bool:
                     yaml_flat["environments"][index]["id"] = env_id
 
             if _is_maintainer() or env_name != "production":
-                with open(env_file, "r", encoding="utf-8") as file:
-                    env_data = file.read()
-                    path = f"{project_group}/{project_name}/{env_name}/{env_id}"
-                    client.secrets.kv.v2.create_or_update_secret(
-                        path=path, secret=env2dict(env_data), mount_point=mount_point
+                path = f"{project_group}/{project_name}/{env_name}/{env_id}"
+                if env_id == stored_ids.get(env_name):
+                    print(
+                        f"Skipping {C_FILE}{env_file}{C_END}, {C_CMD}{path}{C_END} is up to date"
                     )
-                    print(f"Pushing {C_FILE}{env_file}{C_END} to {C_CMD}{path}{C_END}")
+                    continue
+                print(f"Pushing {C_FILE}{env_file}{C_END} to {C_CMD}{path}{C_END}")
+                to_push.append((path, env2dict(env_data)))
+
+        with ThreadPoolExecutor(max_workers=HVAC_MAX_WORKERS) as executor:
+            list(
+                executor.map(
+                    lambda push: client.secrets.kv.v2.create_or_update_secret(
+                        path=push[0], secret=push[1], mount_point=mount_point
+                    ),
+                    to_push,
+                )
+            )
 
         save_flat(DEKICK_HVAC_ENV_FILE, yaml_flat)
 
         if is_git_repository():
-            if not ask(
-                f"\nDo you want to stage {C_FILE}{DEKICK_HVAC_ENV_FILE}{C_END} file?",
-                default=False,
-            ):
+            if not stage:
                 print(
                     f"\n{C_WARN}Remember to add and commit {C_FILE}{DEKICK_HVAC_ENV_FILE}{C_END} file manually!{C_END}"
                 )
@@ -472,26 +521,26 @@ def _get_client(token: str = "") -> hvac.Client:
 
     try:
         if HVAC_CLIENT:
-            try:
-                token_info = HVAC_CLIENT.auth.token.lookup_self()
-                debug(
-                    f"Token info - renewable: {token_info['renewable']}, ttl: {token_info['ttl']}"
-                )
-            except Exception as e:
-                debug(f"Error looking up token: {str(e)}")
-
             _renew_token_self(HVAC_CLIENT)
             return HVAC_CLIENT
 
         username = str(get_global_config_value("hashicorp_vault.username", False))
         password = str(get_global_config_value("hashicorp_vault.password", False))
 
-        HVAC_CLIENT = hvac.Client(url=_get_vault_url())
+        HVAC_CLIENT = hvac.Client(
+            url=_get_vault_url(),
+            session=create_session(),
+            adapter=_CachedTokenAdapter,
+        )
+        HVAC_TOKEN.update(
+            {"expires": None, "creation_ttl": 0, "renewable": False, "cached": False}
+        )
         if token:
             HVAC_CLIENT.token = token
             HVAC_USERNAME = None
         elif username and password:
-            HVAC_CLIENT.auth.userpass.login(username=username, password=password)
+            if not _load_cached_token(HVAC_CLIENT, username, password):
+                _login_userpass(HVAC_CLIENT, username, password)
             HVAC_USERNAME = username
 
         _renew_token_self(HVAC_CLIENT)
@@ -519,6 +568,43 @@ def _get_client(token: str = "") -> hvac.Client:
         )
 
 
+def _login_userpass(client: hvac.Client, username: str, password: str):
+    """Log in with username and password and cache the token for next runs"""
+    auth = client.auth.userpass.login(username=username, password=password)["auth"]
+    HVAC_TOKEN.update(
+        {
+            "expires": time() + int(auth["lease_duration"]),
+            "creation_ttl": int(auth["lease_duration"]),
+            "renewable": bool(auth["renewable"]),
+            "cached": False,
+        }
+    )
+    _save_cached_token(client, username, password)
+
+
+class _CachedTokenAdapter(JSONAdapter):
+    """Logs in again and retries the request once when Vault rejects the token
+    loaded from cache (e.g. it was revoked)"""
+
+    def request(self, method, url, headers=None, raise_exception=True, **kwargs):
+        headers = dict(headers or {})
+        try:
+            return super().request(
+                method, url, dict(headers), raise_exception, **kwargs
+            )
+        except (hvac_exceptions.Forbidden, hvac_exceptions.Unauthorized):
+            if not HVAC_TOKEN["cached"] or not HVAC_USERNAME:
+                raise
+
+        debug("Cached token rejected, logging in again")
+        HVAC_TOKEN["cached"] = False
+        password = str(get_global_config_value("hashicorp_vault.password", False))
+        set_global_config_value(_get_token_cache_key(HVAC_USERNAME), "")
+        _login_userpass(HVAC_CLIENT, HVAC_USERNAME, password)
+
+        return super().request(method, url, dict(headers), raise_exception, **kwargs)
+
+
 def _get_loggedin_user() -> str:
     if HVAC_USERNAME:
         return HVAC_USERNAME
@@ -526,16 +612,138 @@ def _get_loggedin_user() -> str:
 
 
 def _renew_token_self(client: hvac.Client):
+    """Renew token when less than HVAC_TOKEN_RENEW_RATIO of its TTL is left, TTL
+    is looked up once per client and then tracked locally"""
     auto_token_renewal = get_dekickrc_value("hashicorp_vault.auto_token_renewal")
     if bool(auto_token_renewal) is False:
         return
 
+    if HVAC_TOKEN["expires"] is None:
+        token_info = client.auth.token.lookup_self()["data"]
+        debug(
+            f"Token info - renewable: {token_info['renewable']}, ttl: {token_info['ttl']}"
+        )
+        HVAC_TOKEN.update(
+            {
+                "expires": time() + int(token_info["ttl"]),
+                "creation_ttl": int(token_info.get("creation_ttl") or 0),
+                "renewable": bool(token_info["renewable"]),
+            }
+        )
+
+    if not HVAC_TOKEN["renewable"] or not HVAC_TOKEN["creation_ttl"]:
+        return
+
+    remaining_ttl = HVAC_TOKEN["expires"] - time()
+    if remaining_ttl > HVAC_TOKEN["creation_ttl"] * HVAC_TOKEN_RENEW_RATIO:
+        debug(f"Token expires in {int(remaining_ttl)}s, not renewing")
+        return
+
     debug("Renewing token")
-    client.auth.token.renew_self()
+    lease_duration = int(client.auth.token.renew_self()["auth"]["lease_duration"])
+    HVAC_TOKEN["expires"] = time() + lease_duration
+    debug(f"Token renewed, expires in {lease_duration}s")
+
+    if HVAC_USERNAME:
+        password = str(get_global_config_value("hashicorp_vault.password", False))
+        _save_cached_token(client, HVAC_USERNAME, password)
+
+
+def _get_token_cache_key(username: str) -> str:
+    """Get global config key of the cached token for the Vault URL and user"""
+    url_user = f"{_get_vault_url()}|{username}"
+    url_user_hash = hashlib.sha256(url_user.encode()).hexdigest()[:16]
+    return f"{HVAC_TOKEN_CACHE_KEY}.{url_user_hash}"
+
+
+def _load_cached_token(client: hvac.Client, username: str, password: str) -> bool:
+    """Use token cached by previous run unless it's about to expire"""
+    cached = get_global_config_value(_get_token_cache_key(username), False)
+    if not cached:
+        return False
+
+    try:
+        token_data = decrypt(str(cached), password)
+    except ValueError:
+        debug("Cached token can't be decrypted, logging in")
+        return False
+
+    if token_data["expires"] - time() < HVAC_TOKEN_CACHE_MIN_TTL:
+        debug("Cached token is about to expire, logging in")
+        return False
+
+    client.token = token_data["token"]
+    HVAC_TOKEN.update(
+        {
+            "expires": token_data["expires"],
+            "creation_ttl": token_data["creation_ttl"],
+            "renewable": token_data["renewable"],
+            "cached": True,
+        }
+    )
+    debug("Using cached token")
+    return True
 
-    if get_log_level() == "DEBUG":
-        token = client.auth.token.lookup_self()
-        debug("Token: %s" % (token))
+
+def _save_cached_token(client: hvac.Client, username: str, password: str):
+    """Save token encrypted with user's password to global config"""
+    if HVAC_TOKEN["expires"] is None or not HVAC_TOKEN["creation_ttl"]:
+        return
+
+    set_global_config_value(
+        _get_token_cache_key(username),
+        encrypt(
+            {
+                "token": client.token,
+                "expires": HVAC_TOKEN["expires"],
+                "creation_ttl": HVAC_TOKEN["creation_ttl"],
+                "renewable": HVAC_TOKEN["renewable"],
+            },
+            password,
+        ),
+    )
+
+
+def _get_secret_cache_key(env: str) -> str:
+    """Get global config key of the cached secret of the project's environment"""
+    project_name = str(get_dekickrc_value("project.name"))
+    project_group = str(get_dekickrc_value("project.group"))
+    url_path = f"{_get_vault_url()}|{project_group}/{project_name}/{env}"
+    url_path_hash = hashlib.sha256(url_path.encode()).hexdigest()[:16]
+    return f"{HVAC_SECRETS_CACHE_KEY}.{url_path_hash}"
+
+
+def _load_cached_secret(env: str, secret_id: str):
+    """Get cached variables of the environment if they were cached for the same id
+    (checksum of the content), returns None otherwise"""
+    password = str(get_global_config_value("hashicorp_vault.password", False))
+    cached = get_global_config_value(_get_secret_cache_key(env), False)
+    if not password or not cached:
+        return None
+
+    try:
+        secret = decrypt(str(cached), password)
+    except ValueError:
+        debug("Cached secret can't be decrypted")
+        return None
+
+    if secret["id"] != secret_id:
+        debug("Cached secret of %s is outdated", env)
+        return None
+
+    debug("Using cached secret of %s", env)
+    return secret["envs"]
+
+
+def _save_cached_secret(env: str, secret_id: str, envs: str):
+    """Save variables of the environment encrypted with user's password"""
+    password = str(get_global_config_value("hashicorp_vault.password", False))
+    if not password:
+        return
+
+    set_global_config_value(
+        _get_secret_cache_key(env), encrypt({"id": secret_id, "envs": envs}, password)
+    )
 
 
 def generate_word_password(num_words: int = 8) -> str:
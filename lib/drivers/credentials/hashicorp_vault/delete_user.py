@@ -8,7 +8,7 @@ from lib.drivers.credentials.hashicorp_vault._main import (
     ui_select_username,
 )
 from lib.global_config import get_global_config_value
-from lib.hvac import get_entity_by_username
+from lib.hvac import get_entity_by_username, invalidate_users_index
 from lib.settings import C_CODE, C_END
 
 console = Console()
@@ -41,6 +41,7 @@ def ui_action(root_token: str = "") -> bool:
 
         entity = get_entity_by_username(client, username)
         client.secrets.identity.delete_entity(entity_id=entity["id"])
+        invalidate_users_index(client)
         print(f"User {C_CODE}{username}{C_END} deleted")
     except hvac_exceptions.InvalidPath as exception:
         raise ValueError(
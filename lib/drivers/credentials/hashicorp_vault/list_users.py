@@ -8,7 +8,7 @@ from lib.drivers.credentials.hashicorp_vault._main import (
     _prepare_metadata,
     ui_get_for_root_token,
 )
-from lib.hvac import get_all_user_data, get_user_policies
+from lib.hvac import get_all_user_data
 from lib.settings import C_CODE, C_END
 
 console = Console()
@@ -23,12 +23,11 @@ def ui_action(root_token: str = "") -> bool:
     try:
         user_data = get_all_user_data(client)
         for data in user_data:
-            user_policies = get_user_policies(client, data["username"])
             groups = []
             projects = []
             roles = []
 
-            for user_policy in user_policies:
+            for user_policy in data["policies"]:
                 if user_policy == "admin":
                     groups.append("-")
                     projects.append("-")
@@ -1,67 +1,45 @@
 from hvac import exceptions as hvac_exceptions
 from rich.console import Console
 from rich.prompt import Confirm
-from thefuzz import fuzz
+from thefuzz import fuzz, process
 
 from lib.drivers.credentials.hashicorp_vault._main import (
     _create_users_table,
     _get_client,
     _prepare_metadata,
 )
-from lib.hvac import get_user_policies
+from lib.hvac import get_ngrams, get_user_search_text, get_users_index
 from lib.settings import C_CODE, C_END
 
 console = Console()
 ask = Confirm.ask
 
+SEARCH_SCORE_CUTOFF = 85
+
 
 def ui_action() -> bool:
     """Search for users in Hashicorp Vault"""
     client = _get_client()
     users_table = _create_users_table()
     try:
-        entities = client.secrets.identity.list_entities()
+        users_index = get_users_index(client)
     except hvac_exceptions.InvalidPath as exception:
         raise ValueError(
             f"No users to search or vault not initialized (use {C_CODE}dekick credentials run init{C_END} to initialize)"
         ) from exception
 
-    for entity_id in entities["data"]["key_info"]:
-        username = entities["data"]["key_info"][entity_id]["name"]
-        entity_info = client.secrets.identity.read_entity(entity_id=entity_id)
-        metadata = _prepare_metadata(entity_info["data"]["metadata"])
-        entities["data"]["key_info"][entity_id]["metadata"] = metadata
-        entities["data"]["key_info"][entity_id][
-            "search_str"
-        ] = f"{username} {metadata['firstname']} {metadata['lastname']} {metadata['email']} {metadata['companyname']}"
-
     search = input(
         f"Who do you want to find (you can search by username, first name, last name, email and company name)? "
     )
-    matched_entity = []
-    for entity_id, entity in entities["data"]["key_info"].items():
-        username = entity["name"]
-        metadata = entity["metadata"] or {}
-        search_str = entity["search_str"]
-        ratio = fuzz.partial_ratio(search, search_str)
-        if ratio >= 85:
-            matched_entity.append(
-                {
-                    "username": username,
-                    "id": entity_id,
-                    "entity": entity,
-                    "metadata": metadata,
-                }
-            )
+    matched_entity = _search_users(search, users_index)
 
     for entity in matched_entity:
         username = entity["username"]
         metadata = _prepare_metadata(entity["metadata"])
-        user_policies = get_user_policies(client, username)
         groups = []
         projects = []
         roles = []
-        for user_policy in user_policies:
+        for user_policy in entity["policies"]:
             if user_policy == "admin":
                 groups.append("-")
                 projects.append("-")
@@ -85,3 +63,32 @@ def ui_action() -> bool:
     console.print(users_table)
 
     return True
+
+
+def _search_users(search: str, users_index: dict) -> list[dict]:
+    """Find users matching the search, only users sharing an n-gram with the
+    search (looked up in the index) are fuzzy matched"""
+    users = users_index["users"]
+    search_ngrams = get_ngrams(search)
+    entity_ids = (
+        {
+            entity_id
+            for ngram in search_ngrams
+            for entity_id in users_index["ngrams"].get(ngram, [])
+        }
+        if search_ngrams
+        else set(users)
+    )
+    search_strings = {
+        entity_id: get_user_search_text(users[entity_id])
+        for entity_id in sorted(entity_ids)
+    }
+
+    matches = process.extractBests(
+        search,
+        search_strings,
+        scorer=fuzz.partial_ratio,
+        score_cutoff=SEARCH_SCORE_CUTOFF,
+        limit=None,
+    )
+    return [users[entity_id] for _, _, entity_id in matches]
@@ -1,13 +1,51 @@
 """Set of helper functions to interact with HashiCorp Vault."""
 
+import json
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 from logging import debug
+from os import O_CREAT, O_TRUNC, O_WRONLY, fchmod, fdopen, makedirs
+from os import open as os_open
+from os import remove
+from os.path import dirname, exists
+from time import time
 from typing import Union
 
 from hvac import Client
 from hvac import exceptions as hvac_exceptions
+from requests import Session
+from requests.adapters import HTTPAdapter
+from thefuzz import utils
+from urllib3.util.retry import Retry
 
 from lib.dekickrc import get_dekickrc_value
 from lib.environments import get_environments
+from lib.settings import DEKICK_PATH
+
+HVAC_MAX_WORKERS = 8
+HVAC_RETRIES = 3
+HVAC_USERS_INDEX_TTL = 300
+HVAC_USERS_INDEX_MAX_AGE = 3600
+HVAC_USERS_NGRAM_SIZE = 3
+
+
+def create_session() -> Session:
+    """Create HTTP session with connection pool big enough for concurrent requests,
+    idempotent requests are retried with backoff on connection errors and 5xx."""
+    session = Session()
+    retry = Retry(
+        total=HVAC_RETRIES,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"LIST"},
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=HVAC_MAX_WORKERS, max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 def create_mount_point(client: Client):
@@ -182,24 +220,99 @@ def add_policies_to_user(client: Client, username: str, policies: list[str]):
     client.secrets.identity.create_or_update_entity(
         name=username, entity_id=entity_id, policies=policies
     )
+    invalidate_users_index(client)
 
 
 def get_all_user_data(client: Client) -> list[dict]:
-    """Get all user names from Vault."""
+    """Get all users (with metadata and policies) from Vault, entities are read
+    concurrently."""
     entities = client.secrets.identity.list_entities()
-    user_data = []
-    for entity_id in entities["data"]["keys"]:
-        entity_info = client.secrets.identity.read_entity(entity_id=entity_id)
-        metadata = entity_info["data"]["metadata"]
-        entities["data"]["key_info"][entity_id]["metadata"] = metadata
-        user_data.append(
-            {
-                "username": entities["data"]["key_info"][entity_id]["name"],
-                "entity_id": entity_id,
-                "metadata": metadata,
-            }
+    entity_ids = entities["data"]["keys"]
+    key_info = entities["data"]["key_info"]
+
+    with ThreadPoolExecutor(max_workers=HVAC_MAX_WORKERS) as executor:
+        return list(
+            executor.map(
+                lambda entity_id: _read_user(
+                    client, entity_id, key_info[entity_id]["name"]
+                ),
+                entity_ids,
+            )
         )
-    return user_data
+
+
+def get_users_index(client: Client, ttl: int = HVAC_USERS_INDEX_TTL) -> dict:
+    """Get users index: users keyed by entity ID and n-grams of their search text
+    pointing to entity IDs. When the index is older than `ttl` seconds only
+    entities added since then are read from Vault and deleted ones are dropped,
+    after HVAC_USERS_INDEX_MAX_AGE it's rebuilt so changes made elsewhere show up.
+    """
+    index_path = _get_users_index_path(client)
+    index = _read_users_index(index_path)
+
+    if index and time() - index["updated"] < ttl:
+        debug("Using users index %s", index_path)
+        return index
+
+    if index and time() - index["created"] >= HVAC_USERS_INDEX_MAX_AGE:
+        debug("Users index %s is too old, rebuilding it", index_path)
+        index = {}
+
+    entities = client.secrets.identity.list_entities()
+    key_info = entities["data"]["key_info"]
+    cached = index["users"] if index else {}
+    users = {
+        entity_id: cached[entity_id]
+        for entity_id in entities["data"]["keys"]
+        if entity_id in cached
+        and cached[entity_id]["username"] == key_info[entity_id]["name"]
+    }
+    missing = [
+        entity_id for entity_id in entities["data"]["keys"] if entity_id not in users
+    ]
+    debug("Reading %s new or changed entities", len(missing))
+
+    with ThreadPoolExecutor(max_workers=HVAC_MAX_WORKERS) as executor:
+        for user in executor.map(
+            lambda entity_id: _read_user(
+                client, entity_id, key_info[entity_id]["name"]
+            ),
+            missing,
+        ):
+            users[user["entity_id"]] = user
+
+    index = {
+        "created": index["created"] if index else time(),
+        "updated": time(),
+        "users": users,
+        "ngrams": _create_ngrams_index(users),
+    }
+    _save_users_index(index_path, index)
+    return index
+
+
+def get_user_search_text(user: dict) -> str:
+    """Get text the user is searched by: username, name, email and company."""
+    metadata = user["metadata"] or {}
+    fields = ["firstname", "lastname", "email", "companyname"]
+    return " ".join([user["username"]] + [metadata.get(key, "") for key in fields])
+
+
+def get_ngrams(text: str) -> set:
+    """Get n-grams of the text processed the same way as by thefuzz (lowercase,
+    non-alphanumerics replaced by spaces), empty set if text is too short."""
+    text = utils.full_process(text)
+    return {
+        text[i : i + HVAC_USERS_NGRAM_SIZE]
+        for i in range(len(text) - HVAC_USERS_NGRAM_SIZE + 1)
+    }
+
+
+def invalidate_users_index(client: Client):
+    """Remove local users index after users were changed."""
+    index_path = _get_users_index_path(client)
+    if exists(index_path):
+        remove(index_path)
 
 
 def is_user_exists(client: Client, username: str) -> bool:
@@ -268,6 +381,8 @@ def create_or_update_user(
             name=username, metadata=metadata
         )
 
+    invalidate_users_index(client)
+
 
 def create_userpass(client: Client, username: str, password: Union[str, None]):
     """Create a user in Vault."""
@@ -304,6 +419,59 @@ def _get_userpass_mount_accessor(client: Client) -> str:
     )
 
 
+def _read_user(client: Client, entity_id: str, username: str) -> dict:
+    """Read entity and return user data."""
+    entity_info = client.secrets.identity.read_entity(entity_id=entity_id)
+    return {
+        "username": username,
+        "entity_id": entity_id,
+        "metadata": entity_info["data"]["metadata"],
+        "policies": entity_info["data"]["policies"] or [],
+    }
+
+
+def _get_users_index_path(client: Client) -> str:
+    """Get path of the users index, separate for each Vault."""
+    url_hash = sha1(str(client.url).encode("utf-8")).hexdigest()[:16]
+    return f"{DEKICK_PATH}/tmp/hvac-users-{url_hash}.json"
+
+
+def _read_users_index(index_path: str) -> dict:
+    """Read users index, returns empty dict if it's missing or broken."""
+    if not exists(index_path):
+        return {}
+
+    try:
+        with open(index_path, encoding="utf-8") as file:
+            index = json.load(file)
+    except ValueError:
+        return {}
+
+    keys = ["created", "updated", "users", "ngrams"]
+    if not isinstance(index, dict) or any(key not in index for key in keys):
+        return {}
+
+    return index
+
+
+def _create_ngrams_index(users: dict) -> dict:
+    """Map n-grams of users' search text to their entity IDs."""
+    ngrams: dict = {}
+    for entity_id, user in users.items():
+        for ngram in get_ngrams(get_user_search_text(user)):
+            ngrams.setdefault(ngram, []).append(entity_id)
+    return ngrams
+
+
+def _save_users_index(index_path: str, index: dict):
+    """Save users index readable only by the current user."""
+    makedirs(dirname(index_path), exist_ok=True)
+    descriptor = os_open(index_path, O_CREAT | O_TRUNC | O_WRONLY, 0o600)
+    fchmod(descriptor, 0o600)
+    with fdopen(descriptor, "w", encoding="utf-8") as file:
+        json.dump(index, file)
+
+
 def _create_path(project_name: str, project_group: str) -> str:
     """Create a path for the project."""
     return f"{project_group}/{project_name}"
@@ -0,0 +1,176 @@
+"""Image size and layer report shown after the image is built"""
+import json
+from logging import debug
+from os import makedirs
+from os.path import dirname, exists
+from shlex import quote
+
+from humanfriendly import format_size, parse_size
+from rich.console import Console
+from rich.table import Table
+
+from lib.fs import chown
+from lib.misc import run_shell
+from lib.run_func import run_func
+from lib.settings import (
+    C_CODE,
+    C_END,
+    C_ERROR,
+    DEKICK_PATH,
+    TERMINAL_COLUMN_WIDTH,
+)
+
+IMAGE_REPORT_FILE = f"{DEKICK_PATH}/tmp/image-reports.json"
+
+console = Console()
+
+
+def report_image_size(image: str, max_size: str = "", compression: str = "gzip"):
+    """Show size of image layers and compare the image with the previous build of
+    the same tag, raises RuntimeError if compressed size exceeds `max_size`"""
+    report: dict = {}
+
+    def run():
+        report.update(get_image_report(image, compression))
+        previous = read_image_reports().get(image)
+        save_image_report(image, report)
+
+        text = (
+            f"Image {C_CODE}{image}{C_END} is {format_size(report['size'])} "
+            + f"({format_size(report['compressed_size'])} {compression} compressed)"
+        )
+        if previous:
+            text += get_size_change(report, previous)
+
+        if max_size and report["compressed_size"] > parse_size(max_size):
+            return {
+                "success": False,
+                "text": text + f", {C_ERROR}exceeds {max_size} budget{C_END}",
+            }
+
+        return {"success": True, "text": text}
+
+    within_budget = run_func(
+        text=f"Analyzing size of image {C_CODE}{image}{C_END}",
+        func=run,
+        terminate=False,
+    )
+
+    if report:
+        console.print(get_layers_table(report["layers"]))
+        console.print(
+            f"Report saved to [bright_cyan]{IMAGE_REPORT_FILE}[/]\n", highlight=False
+        )
+
+    if not within_budget:
+        raise RuntimeError(f"Image {image} exceeds size budget of {max_size}")
+
+
+def get_image_report(image: str, compression: str = "gzip") -> dict:
+    """Get sizes of the image and its layers (with instructions they were created by)"""
+    history = run_shell(
+        [
+            "docker",
+            "history",
+            "--no-trunc",
+            "--human=false",
+            "--format",
+            "{{json .}}",
+            image,
+        ],
+        capture_output=True,
+    )["stdout"]
+    layers = []
+
+    for line in reversed(history.strip().splitlines()):
+        try:
+            entry = json.loads(line)
+            size = int(entry.get("Size", 0))
+        except ValueError:
+            debug("Skipping unparsable history line %s", line)
+            continue
+        instruction = get_instruction(entry.get("CreatedBy", ""))
+        layers.append({"instruction": instruction, "size": size})
+
+    size = run_shell(
+        ["docker", "image", "inspect", "--format", "{{.Size}}", image],
+        capture_output=True,
+    )["stdout"].strip()
+    compress_cmd = "zstd -3 -T0 -q -c" if compression == "zstd" else "gzip -1 -c"
+    compressed_size = run_shell(
+        ["sh", "-c", f"docker save {quote(image)} | {compress_cmd} | wc -c"],
+        capture_output=True,
+    )["stdout"].strip()
+
+    return {
+        "size": int(size),
+        "compressed_size": int(compressed_size),
+        "layers": layers,
+    }
+
+
+def get_instruction(created_by: str) -> str:
+    """Turn `docker history` CreatedBy into Dockerfile-like instruction"""
+    instruction = created_by.strip()
+
+    for prefix in ("/bin/sh -c #(nop) ", "/bin/sh -c "):
+        if instruction.startswith(prefix):
+            instruction = instruction[len(prefix) :]
+            if prefix == "/bin/sh -c ":
+                instruction = f"RUN {instruction}"
+            break
+
+    return instruction.replace(" # buildkit", "").strip()
+
+
+def get_size_change(report: dict, previous: dict) -> str:
+    """Describe change of compressed size against the previous report"""
+    change = report["compressed_size"] - previous["compressed_size"]
+
+    if change == 0:
+        return ", same size as previous build"
+
+    sign = "+" if change > 0 else "-"
+    return f", {sign}{format_size(abs(change))} since previous build"
+
+
+def get_layers_table(layers: list) -> Table:
+    """Create a table with non-empty layers, largest layers are highlighted"""
+    table = Table(show_header=True, header_style="bold", width=TERMINAL_COLUMN_WIDTH)
+    table.add_column("Size", style="green", justify="right", no_wrap=True)
+    table.add_column("Instruction", style="white", overflow="ellipsis", no_wrap=True)
+    largest = sorted((layer["size"] for layer in layers), reverse=True)[:3]
+
+    for layer in layers:
+        if layer["size"] == 0:
+            continue
+        style = "bold red" if layer["size"] in largest else None
+        table.add_row(format_size(layer["size"]), layer["instruction"], style=style)
+
+    return table
+
+
+def read_image_reports() -> dict:
+    """Read reports of previous builds, keyed by image tag"""
+    if not exists(IMAGE_REPORT_FILE):
+        return {}
+
+    try:
+        with open(IMAGE_REPORT_FILE, encoding="utf-8") as file:
+            reports = json.load(file)
+    except ValueError:
+        return {}
+
+    return reports if isinstance(reports, dict) else {}
+
+
+def save_image_report(image: str, report: dict):
+    """Save report of the image replacing report of its previous build"""
+    reports = read_image_reports()
+    reports[image] = report
+    makedirs(dirname(IMAGE_REPORT_FILE), exist_ok=True)
+
+    with open(IMAGE_REPORT_FILE, "w", encoding="utf-8") as file:
+        json.dump(reports, file, indent=2)
+
+    chown(IMAGE_REPORT_FILE)
@@ -7,7 +7,6 @@ import logging
 import os
 import platform
 import sys
-import tempfile
 import time
 from importlib import import_module
 from os.path import basename, exists
@@ -18,7 +17,7 @@ from typing import Union
 from rich.traceback import install
 
 from lib.dekickrc import get_dekickrc_value
-from lib.dind import get_dind_container_id, is_dind_running
+from lib.dind import get_dind_container_id, get_dind_env_args, is_dind_running
 from lib.logger import get_log_filename
 from lib.settings import (
     C_BOLD,
@@ -265,11 +264,6 @@ def run_shell(
     logfile = get_log_filename()
 
     if is_dind_running():
-        tmp_docker_env = []
-
-        for key, value in env.items():
-            tmp_docker_env = tmp_docker_env + ["-e", f"{key}={value}"]
-
         dind_container_id = get_dind_container_id()
         cmd = [
             "docker",
@@ -278,7 +272,7 @@ def run_shell(
             CURRENT_UID,
             "-w",
             os.getcwd(),
-            *tmp_docker_env,
+            *get_dind_env_args(env),
             dind_container_id,
         ] + list(cmd)
 
@@ -361,12 +355,6 @@ def get_colored_diff(old: str, new: str) -> Union[str, bool]:
     # return lines_only.strip()
 
 
-def create_temporary_dir() -> str:
-    """Creates temporary directory"""
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        return tmp_dir
-
-
 def check_argparse_arg(arg, name):
     """Checks if required argument is passed"""
     if arg is None:
@@ -1,16 +1,23 @@
+import re
 import urllib.request
 from logging import error, info
 from os import getenv
-from time import sleep
+from time import monotonic, sleep
 
 from lib.rbash import rbash
 from lib.settings import DEKICK_PATH
 
 REGISTRY_DOCKER_COMPOSE = DEKICK_PATH + "/docker/registry/docker-compose.yml"
+REGISTRY_URL = "http://proxy:3128/"
+REGISTRY_SEARCH_STRING = "The docker caching proxy is working"
 
 
 def start_docker_registry():
-    """Starts Docker registry"""
+    """Starts Docker registry, does nothing if it's already up and running"""
+    if is_docker_registry_running():
+        info("Docker registry is already up and running")
+        return
+
     rbash(
         "Starting Docker registry proxy",
         f"docker compose -f {REGISTRY_DOCKER_COMPOSE} up -d --no-recreate --quiet-pull",
@@ -19,30 +26,68 @@ def start_docker_registry():
     wait_for_docker_registry()
 
 
+def is_docker_registry_running() -> bool:
+    """Check whether Docker registry answers on its HTTP port"""
+    try:
+        with urllib.request.urlopen(REGISTRY_URL, timeout=1) as response:
+            return REGISTRY_SEARCH_STRING in str(response.read())
+    except Exception:  # pylint: disable=broad-except
+        return False
+
+
 def wait_for_docker_registry():
-    """Wait for Docker registry to start"""
-    timer = 0
+    """Wait for Docker registry to start, probing with a short, growing delay"""
     timeout = 30
-    search_string = "The docker caching proxy is working"
-    url = "http://proxy:3128/"
-
-    while timer < timeout:
-        try:
-            info("Waiting for Docker registry to start... %s", timer)
-            contents = str(urllib.request.urlopen(url).read())
-            if search_string in contents:
-                info("Docker registry is up and running")
-                return
-        except Exception:  # pylint: disable=broad-except
-            pass
-
-        sleep(1)
-        timer = timer + 1
+    delay = 0.05
+    deadline = monotonic() + timeout
+
+    while monotonic() < deadline:
+        info("Waiting for Docker registry to start...")
+        if is_docker_registry_running():
+            info("Docker registry is up and running")
+            return
+
+        sleep(delay)
+        delay = min(delay * 2, 1)
 
     error("Docker registry didn't start properly")
     raise Exception("Docker registry didn't start properly")
 
 
+def get_docker_registry_cache_stats() -> dict:
+    """Count cache hits and misses in Docker registry access logs"""
+    ret = rbash(
+        "Reading Docker registry logs",
+        f"docker compose -f {REGISTRY_DOCKER_COMPOSE} logs --no-log-prefix registry",
+        env=get_env(),
+    )
+    stats = {"hits": 0, "misses": 0}
+
+    for line in ret["stdout"].splitlines():
+        match = re.match(r"^(HIT|REVALIDATED|STALE|MISS|EXPIRED)\s", line)
+        if match is None:
+            continue
+        if match.group(1) in ("MISS", "EXPIRED"):
+            stats["misses"] += 1
+        else:
+            stats["hits"] += 1
+
+    return stats
+
+
+def get_docker_registry_cache_size() -> str:
+    """Get size of Docker registry cache, empty when it can't be read"""
+    ret = rbash(
+        "Checking Docker registry cache size",
+        f"docker compose -f {REGISTRY_DOCKER_COMPOSE} exec -T registry "
+        + "du -sh /docker_mirror_cache",
+        env=get_env(),
+    )
+    if ret["code"] != 0 or ret["stdout"].strip() == "":
+        return ""
+    return ret["stdout"].split()[0]
+
+
 def get_env():
     """Returns environment variables"""
     return {"COMPOSE_PROJECT_NAME": "dekick-registry", "PATH": getenv("PATH")}
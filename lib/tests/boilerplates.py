@@ -1,9 +1,10 @@
-from logging import fatal, warning
+from logging import fatal
 from os import getcwd
 from re import match
 
 from rich.traceback import install
 
+from lib.boilerplates import export_boilerplates, update_boilerplates_mirror
 from lib.dekickrc import get_dekick_version
 from lib.dotenv import get_dotenv_var
 from lib.rbash import rbash
@@ -41,29 +42,16 @@ def get_boilerplates_tag() -> str:
 
 
 def download_boilerplates() -> bool:
-    """Downloads boilerplates to BOILERPLATES_BASE_PATH directory"""
-    boilerplates_git_url = get_boilerplates_git_url()
+    """Exports boilerplates from the shared mirror to BOILERPLATES_ROOT directory"""
     boilerplates_path = get_boilerplates_path()
-    boilerplates_tag = get_boilerplates_tag()
 
-    ret = rbash(
+    rbash(
         "Add safe.directory to git config",
         "git config --global --add safe.directory '*'",
     )
+    update_boilerplates_mirror(get_boilerplates_git_url())
+    reset_boilerplates()
 
-    ret = rbash(
-        "Downloading boilerplates",
-        f'git clone -b master "{boilerplates_git_url}" "{boilerplates_path}"',
-    )
-
-    if ret["code"] == 128:
-        warning("Boilerplates already exists")
-        reset_boilerplates()
-
-    rbash(
-        f"Switching to tag/branch {boilerplates_tag}",
-        f"cd {boilerplates_path};" + f"git checkout {boilerplates_tag}",
-    )
     return rbash("Checking directory exists", f"ls {boilerplates_path}")["stdout"] != ""
 
 
@@ -110,11 +98,10 @@ def get_project_root() -> str:
 
 
 def reset_boilerplates() -> bool:
-    """Resets boilerplates repository to initial position"""
+    """Resets boilerplates to files of the tag/branch from the mirror"""
     boilerplates_path = get_boilerplates_path()
+    boilerplates_tag = get_boilerplates_tag()
 
-    rbash(
-        "Resetting boilerplates",
-        f"cd {boilerplates_path}; git pull; git reset --hard HEAD; git clean -fdx",
-    )
+    delete_boilerplates()
+    export_boilerplates(boilerplates_tag, boilerplates_path)
     return True
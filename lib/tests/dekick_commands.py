@@ -12,9 +12,14 @@ from lib.tests.boilerplates import get_boilerplates_path
 from lib.tests.dind import get_dind_container_id, rbash_dind
 from lib.tests.docker import get_docker_env
 from lib.tests.misc import get_dekick_runner
+from lib.tests.snapshots import restore_snapshot, save_snapshot
 
 install()
 
+# Changes a test made to the project before running DeKick, re-applied on top
+# of restored snapshot
+TEST_STATE = {"local_ran": False, "dotenv": {}}
+
 
 def _dekick_command_wrapper(args: list, flavour: str, version: str) -> dict:
     """Runs DeKick command with given arguments, flavour and version of the boilerplate used"""
@@ -32,10 +37,33 @@ def _dekick_command_wrapper(args: list, flavour: str, version: str) -> dict:
     )
 
 
+def reset_test_state():
+    """Forgets changes made by the previous test, called before each test"""
+    TEST_STATE.update({"local_ran": False, "dotenv": {}})
+
+
 def dekick_local(flavour: str, version: str) -> bool:
-    """Runs dekick local command with given flavour and version of the boilerplate used"""
+    """Runs dekick local command with given flavour and version of the boilerplate used,
+    the first run in a test starts from the snapshot of previous successful run
+    if there is one"""
+    restored = False
+
+    if not TEST_STATE["local_ran"]:
+        TEST_STATE["local_ran"] = True
+        restored = restore_snapshot(flavour, version)
+
+    if restored and TEST_STATE["dotenv"]:
+        dekick_dotenv_replace(flavour, version, TEST_STATE["dotenv"])
+
     proc = _dekick_command_wrapper(["local"], flavour, version)
-    return proc["code"] == 0
+
+    if proc["code"] != 0:
+        return False
+
+    if not restored and not TEST_STATE["dotenv"]:
+        save_snapshot(flavour, version)
+
+    return True
 
 
 def dekick_status(flavour: str, version: str) -> bool:
@@ -94,6 +122,7 @@ def dekick_dotenv_replace(flavour: str, version: str, env: dict) -> bool:
         )
 
         remove(tmp_env_file)
+        TEST_STATE["dotenv"] = env
 
     except Exception:  # pylint: disable=broad-except
         return False
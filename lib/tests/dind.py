@@ -11,6 +11,7 @@ from lib.settings import (
     DEKICKRC_GLOBAL_PATH,
     DEKICKRC_GLOBAL_TMPL_PATH,
 )
+from lib.tests.boilerplates import get_project_root
 
 DIND_CONTAINER_ID = ""
 
@@ -47,7 +48,7 @@ def start_dind_container(count: int = 0) -> str:
         ret = rbash(
             "Waiting for DinD to start then change permissions of docker socket",
             f'docker exec "{dind_container_id}" bash -c "while ! '
-            + "docker ps >/dev/null 2>&1; do sleep 1; done; chmod 666 /var/run/docker.sock; "
+            + "docker ps >/dev/null 2>&1; do sleep 0.1; done; chmod 666 /var/run/docker.sock; "
             + f"adduser -D -h /tmp/homedir -u {current_uid} {current_username}"
             + ';"',
         )
@@ -80,6 +81,20 @@ def start_dind_container(count: int = 0) -> str:
     return DIND_CONTAINER_ID
 
 
+def reset_dind_container():
+    """Remove containers, volumes, networks and project files left by a test,
+    pulled and built images are kept so the next test doesn't pull them again"""
+    dind_container_id = get_dind_container_id()
+    project_root = get_project_root()
+    rbash(
+        "Resetting DinD container",
+        f'docker exec "{dind_container_id}" sh -c "'
+        + "docker ps -aq | xargs -r docker rm -f -v; "
+        + "docker volume prune -af; docker network prune -f; "
+        + f'rm -rf {project_root}"',
+    )
+
+
 def stop_dind_container():
     """Stop the Docker-in-Docker container"""
     global DIND_CONTAINER_ID  # pylint: disable=global-statement
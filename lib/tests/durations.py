@@ -0,0 +1,83 @@
+"""Test durations used to schedule the longest tests first and size the workers"""
+import json
+from heapq import heapify, heappop, heappush
+from logging import debug
+from os import cpu_count, makedirs, sysconf
+from os.path import dirname, exists
+
+from lib.settings import DEKICK_PATH
+
+DURATIONS_PATH = f"{DEKICK_PATH}/tmp/pytest-durations.json"
+DEFAULT_DURATION = 60.0
+DIND_CPUS = 2
+DIND_MEMORY = 4 * 1024**3
+
+
+def read_durations() -> dict:
+    """Reads durations (in seconds) of previous runs keyed by test node id"""
+    if not exists(DURATIONS_PATH):
+        return {}
+
+    try:
+        with open(DURATIONS_PATH, encoding="utf-8") as file:
+            durations = json.load(file)
+    except ValueError:
+        return {}
+
+    return durations if isinstance(durations, dict) else {}
+
+
+def save_durations(durations: dict):
+    """Saves durations of tests from this run, keeping durations of tests not run"""
+    if not durations:
+        return
+
+    makedirs(dirname(DURATIONS_PATH), exist_ok=True)
+    saved = read_durations()
+    saved.update(durations)
+
+    with open(DURATIONS_PATH, "w", encoding="utf-8") as file:
+        json.dump(saved, file, indent=2, sort_keys=True)
+
+
+def get_duration(durations: dict, node_id: str) -> float:
+    """Gets duration of the test, tests never run before are assumed to be long"""
+    return float(durations.get(node_id, DEFAULT_DURATION))
+
+
+def sort_longest_first(node_ids: list, durations: dict) -> list:
+    """Sorts tests so the longest ones are started first"""
+    return sorted(node_ids, key=lambda node_id: -get_duration(durations, node_id))
+
+
+def predict_wall_time(node_ids: list, durations: dict, workers: int) -> float:
+    """Predicts wall time of running tests longest-first on `workers` workers,
+    every test goes to the worker which becomes free first"""
+    loads = [0.0] * max(workers, 1)
+    heapify(loads)
+
+    for node_id in sort_longest_first(node_ids, durations):
+        heappush(loads, heappop(loads) + get_duration(durations, node_id))
+
+    return max(loads)
+
+
+def get_available_memory() -> int:
+    """Gets available memory in bytes, falls back to total memory"""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return sysconf("SC_PAGE_SIZE") * sysconf("SC_PHYS_PAGES")
+
+
+def get_num_workers() -> int:
+    """Gets number of workers (each running its own DinD) the machine can handle"""
+    by_cpu = (cpu_count() or 1) // DIND_CPUS
+    by_memory = get_available_memory() // DIND_MEMORY
+    debug("Workers by CPU: %s, by memory: %s", by_cpu, by_memory)
+    return max(1, min(by_cpu, by_memory))
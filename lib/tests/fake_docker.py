@@ -0,0 +1,65 @@
+"""Runs DeKick against fake `docker` executable (lib/tests/bin/docker) which
+returns scripted responses and records every invocation"""
+import json
+from os import getcwd, getenv
+from os.path import dirname
+from shutil import copytree
+from tempfile import mkdtemp
+
+from lib.rbash import rbash
+from lib.tests.boilerplates import get_boilerplates_path
+from lib.tests.misc import get_dekick_runner
+
+FAKE_DOCKER_BIN_PATH = f"{dirname(__file__)}/bin"
+
+
+def run_dekick_with_fake_docker(
+    args: list, flavour: str, version: str, responses: list
+) -> dict:
+    """Runs DeKick command in a copy of the flavour/version boilerplate, `docker`
+    is the fake one so nothing is really started
+
+    Args:
+        args (list): DeKick command and its arguments
+        responses (list): {"args", "stdout", "stderr", "returncode"} dicts,
+            first one with "args" being a prefix of invocation arguments is used
+
+    Returns:
+        dict: ["code": int, "stdout": str, "invocations": list of docker arguments]
+    """
+    tmp_path = mkdtemp(prefix="fake-docker-", dir=f"{getcwd()}/tmp")
+    project_root = f"{tmp_path}/project"
+    copytree(f"{get_boilerplates_path()}{flavour}/{version}", project_root)
+
+    log_path = f"{tmp_path}/invocations.log"
+    responses_path = f"{tmp_path}/responses.json"
+    with open(responses_path, "w", encoding="utf-8") as file:
+        json.dump(responses, file)
+
+    env = {
+        "HOME": getenv("HOME") or tmp_path,
+        "PATH": f"{FAKE_DOCKER_BIN_PATH}:{getenv('PATH')}",
+        "DEKICK_PATH": getcwd(),
+        "PROJECT_ROOT": project_root,
+        "DEKICK_FAKE_DOCKER_LOG": log_path,
+        "DEKICK_FAKE_DOCKER_RESPONSES": responses_path,
+    }
+    ret = rbash(
+        f"Running 'dekick {' '.join(args)}' with fake docker",
+        f'cd "{project_root}" && touch "{log_path}" && '
+        + f"{get_dekick_runner()} {' '.join(args)} --log-level DEBUG "
+        + "--log-filename=stdout",
+        env=env,
+    )
+
+    return {
+        "code": ret["code"],
+        "stdout": ret["stdout"],
+        "invocations": read_invocations(log_path),
+    }
+
+
+def read_invocations(log_path: str) -> list:
+    """Reads arguments of every `docker` invocation"""
+    with open(log_path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
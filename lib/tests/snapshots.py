@@ -0,0 +1,137 @@
+"""Snapshots of DinD state after successful `dekick local` of a flavour/version"""
+
+from glob import glob
+from hashlib import sha1
+from logging import debug, warning
+from os import getcwd, getenv, makedirs, remove, rename
+from os.path import exists
+
+from filelock import FileLock
+
+from lib.boilerplates import get_boilerplates_commit
+from lib.tests.boilerplates import get_boilerplates_tag, get_project_root
+from lib.tests.dind import get_dekick_version, rbash_dind
+
+SNAPSHOTS_PATH = getcwd() + "/tmp/snapshots/"
+DOCKER_VOLUMES_PATH = "/var/lib/docker/volumes"
+
+
+def run_in_dind(info_desc: str, cmd: str) -> dict:
+    """Runs command in DinD as root, `$` is escaped so it's expanded inside DinD"""
+    return rbash_dind(info_desc, cmd.replace("$", "\\$"), user="root")
+
+
+def is_snapshots_enabled() -> bool:
+    """Snapshots can be disabled with DEKICK_TEST_SNAPSHOTS=0"""
+    return getenv("DEKICK_TEST_SNAPSHOTS", "1") != "0"
+
+
+def get_snapshot_path(flavour: str, version: str) -> str:
+    """Gets snapshot path, it changes with boilerplates commit and DeKick version"""
+    commit = get_boilerplates_commit(get_boilerplates_tag())
+    key = sha1(
+        f"{flavour}|{version}|{commit}|{get_dekick_version()}".encode("utf-8")
+    ).hexdigest()[:16]
+    return f"{SNAPSHOTS_PATH}{flavour}__{version}__{key}"
+
+
+def save_snapshot(flavour: str, version: str) -> bool:
+    """Saves images, Docker volumes and project files of the DinD container.
+
+    Containers are stopped while volumes are archived so databases are
+    consistent and started again afterwards.
+    """
+    if not is_snapshots_enabled():
+        return False
+
+    snapshot_path = get_snapshot_path(flavour, version)
+    makedirs(SNAPSHOTS_PATH, exist_ok=True)
+
+    with FileLock(f"{snapshot_path}.lock"):
+        if exists(snapshot_path):
+            return True
+
+        tmp_path = f"{snapshot_path}.tmp"
+
+        ret = run_in_dind(
+            f"Saving snapshot of {flavour}/{version}",
+            f'set -e; rm -rf "{tmp_path}"; mkdir -p "{tmp_path}"; cd "{tmp_path}"; '
+            + "docker ps -q > running.txt; "
+            + "xargs -r docker stop < running.txt > /dev/null; "
+            + "docker images --format '{{.Repository}}:{{.Tag}}' "
+            + "| grep -v '<none>' > images.txt; "
+            + "xargs -r docker save -o images.tar < images.txt; "
+            + "docker volume ls --format '{{.Name}} {{.Labels}}' > volumes.txt; "
+            + f"tar -C {DOCKER_VOLUMES_PATH} -cf volumes.tar "
+            + "--exclude metadata.db --exclude backingFsBlockDev .; "
+            + f'tar -C "{get_project_root()}" -cf project.tar .; '
+            + "xargs -r docker start < running.txt > /dev/null",
+        )
+
+        if ret["code"] != 0:
+            warning("Failed to save snapshot of %s/%s", flavour, version)
+            run_in_dind("Removing incomplete snapshot", f'rm -rf "{tmp_path}"')
+            return False
+
+        rename(tmp_path, snapshot_path)
+
+    debug("Snapshot saved to %s", snapshot_path)
+    prune_snapshots(flavour, version, snapshot_path)
+    return True
+
+
+def prune_snapshots(flavour: str, version: str, snapshot_path: str):
+    """Removes snapshots of the flavour/version superseded by `snapshot_path`
+    (made for another boilerplates commit or DeKick version)"""
+    for path in glob(f"{SNAPSHOTS_PATH}{flavour}__{version}__*"):
+        if path.endswith((".lock", ".tmp")) or path == snapshot_path:
+            continue
+
+        with FileLock(f"{path}.lock"):
+            run_in_dind("Removing superseded snapshot", f'rm -rf "{path}" "{path}.tmp"')
+        try:
+            remove(f"{path}.lock")
+        except FileNotFoundError:
+            pass
+        debug("Snapshot %s removed", path)
+
+
+def restore_snapshot(flavour: str, version: str) -> bool:
+    """Restores images, Docker volumes and project files saved by `save_snapshot`
+    into a freshly reset DinD container, returns False if there's no snapshot.
+
+    Project files are extracted over the boilerplate copied by the test setup,
+    changes the test made itself have to be applied again afterwards.
+    """
+    if not is_snapshots_enabled():
+        return False
+
+    snapshot_path = get_snapshot_path(flavour, version)
+
+    if not exists(snapshot_path):
+        return False
+
+    ret = run_in_dind(
+        f"Restoring snapshot of {flavour}/{version}",
+        f'set -e; cd "{snapshot_path}"; '
+        + "while read -r image; do "
+        + "docker image inspect $image > /dev/null 2>&1 "
+        + "|| { docker load -q -i images.tar > /dev/null; break; }; "
+        + "done < images.txt; "
+        + "while read -r name labels; do "
+        + "args=''; for label in $(echo $labels | tr , ' '); do "
+        + 'args="$args --label $label"; done; '
+        + "docker volume create $args $name > /dev/null; "
+        + "done < volumes.txt; "
+        + f"tar -C {DOCKER_VOLUMES_PATH} -xf volumes.tar; "
+        + f'mkdir -p "{get_project_root()}"; '
+        + f'tar -C "{get_project_root()}" -xf project.tar',
+    )
+
+    if ret["code"] != 0:
+        raise RuntimeError(
+            f"Failed to restore snapshot {snapshot_path}, remove it to start over"
+        )
+
+    debug("Snapshot restored from %s", snapshot_path)
+    return True
@@ -1,16 +1,32 @@
+from glob import glob
 from logging import basicConfig, debug
 from os import environ, makedirs, path, remove, rename
 from os.path import dirname, exists
-from time import sleep
+from time import monotonic
+from uuid import uuid4
 
 import pytest
-from filelock import SoftFileLock, Timeout
+from filelock import FileLock
 
 from lib.registry import start_docker_registry
 from lib.tests.boilerplates import copy_flavour_to_container, download_boilerplates
-from lib.tests.dind import start_dind_container, stop_dind_container
+from lib.tests.dekick_commands import reset_test_state
+from lib.tests.dind import (
+    reset_dind_container,
+    start_dind_container,
+    stop_dind_container,
+)
+from lib.tests.durations import (
+    get_duration,
+    get_num_workers,
+    predict_wall_time,
+    read_durations,
+    save_durations,
+)
 from lib.tests.misc import parse_flavour_version
 
+SESSION = {"started": 0.0, "node_ids": [], "previous": {}, "durations": {}}
+
 
 def pytest_configure(config):
     """Setup different logs for each worker"""
@@ -33,56 +49,122 @@ def pytest_configure(config):
         )
 
 
-def init_session():
-    """Do some things before workers start"""
-    lock_path = "tmp/pytest.lock"
-    makedirs(dirname(lock_path), exist_ok=True)
+def pytest_sessionstart(session):  # pylint: disable=unused-argument
+    """Remember when the run started and durations of previous runs"""
+    SESSION["started"] = monotonic()
+    SESSION["previous"] = read_durations()
 
-    worker_id = environ.get("PYTEST_XDIST_WORKER")
-    debug("worker_id: %s", worker_id)
 
-    timeout = int(
-        0 if worker_id is None or worker_id == "master" else worker_id.replace("gw", "")
-    )
-    sleep(timeout)
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_auto_num_workers(config):  # pylint: disable=unused-argument
+    """Number of workers for `-n auto` based on CPU and memory needed by DinD"""
+    return get_num_workers()
+
 
-    lock = SoftFileLock(lock_path, timeout=240)
+def pytest_collection_modifyitems(config, items):  # pylint: disable=unused-argument
+    """Run the longest tests (by durations from previous runs) first"""
+    durations = SESSION["previous"]
+    items.sort(key=lambda item: -get_duration(durations, item.nodeid))
+    SESSION["node_ids"] = [item.nodeid for item in items]
 
-    try:
-        lock.acquire(poll_interval=1, timeout=5)
-    except Timeout:
-        lock.acquire(poll_interval=1)
-        debug("Lock acquired, let's move!")
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_node_collection_finished(node, ids):  # pylint: disable=unused-argument
+    """Collection happens on workers only, keep the test ids for the prediction"""
+    SESSION["node_ids"] = ids
+
+
+def pytest_runtest_logreport(report):
+    """Sum up setup, call and teardown durations of each passed test"""
+    if report.failed or report.skipped:
         return
-    else:
 
-        if exists(lock_path):
-            remove(lock_path)
+    durations = SESSION["durations"]
+    durations[report.nodeid] = durations.get(report.nodeid, 0.0) + report.duration
+
+
+def pytest_sessionfinish(session):
+    """Save durations of the tests, done by the controller (or single process)"""
+    if hasattr(session.config, "workerinput"):
+        return
+
+    save_durations(SESSION["durations"])
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    """Print predicted and actual wall time of the run"""
+    workers = config.getoption("numprocesses", None)
+    if not isinstance(workers, int) or workers < 1:
+        workers = 1
+
+    predicted = predict_wall_time(SESSION["node_ids"], SESSION["previous"], workers)
+    terminalreporter.write_line(
+        f"Wall time on {workers} worker(s): predicted {predicted:.0f}s, "
+        + f"actual {monotonic() - SESSION['started']:.0f}s"
+    )
+
+
+def run_once_per_session(step: str, func):
+    """Run `func` once per test run, the first worker does it while others wait
+    for the lock and then find the done marker of the step"""
+    lock_path = f"tmp/pytest-{step}.lock"
+    makedirs(dirname(lock_path), exist_ok=True)
 
-        with SoftFileLock(lock_path):
-            start_docker_registry()
-            download_boilerplates()
+    worker_id = environ.get("PYTEST_XDIST_WORKER")
+    run_id = environ.get("PYTEST_XDIST_TESTRUNUID") or uuid4().hex
+    done_path = f"tmp/pytest-session-{step}-{run_id}.done"
+    debug("step: %s, worker_id: %s, run_id: %s", step, worker_id, run_id)
+
+    with FileLock(lock_path, timeout=600):
+        if exists(done_path):
+            debug("Step %s already done by another worker", step)
             return
 
+        func()
+
+        for previous_done_path in glob(f"tmp/pytest-session-{step}-*.done"):
+            remove(previous_done_path)
+        with open(done_path, "w", encoding="utf-8"):
+            pass
 
-@pytest.fixture(scope="session", autouse=True)
-def start_session():
-    """Setup boilerplates before running tests"""
+
+@pytest.fixture(scope="session", name="boilerplates")
+def fixture_boilerplates():
+    """Boilerplates downloaded once per test run, it doesn't need Docker so tests
+    using fake docker get them too"""
     debug("start session")
-    init_session()
+    run_once_per_session("boilerplates", download_boilerplates)
+
+
+@pytest.fixture(scope="session", name="docker_registry")
+def fixture_docker_registry():
+    """Registry proxy used by DinD containers, started once per test run"""
+    run_once_per_session("registry", start_docker_registry)
+
+
+@pytest.fixture(scope="session", name="worker_dind_container")
+def fixture_worker_dind_container(docker_registry):  # pylint: disable=unused-argument
+    """One DinD container per worker, reused by all tests the worker runs"""
+    container_id = start_dind_container()
+    yield container_id
+    stop_dind_container()
 
 
 @pytest.fixture(scope="function", autouse=True)
 def start_function(request):
-    """Cleans up boilerplates and stops containers before running test"""
-    container_id = start_dind_container()
+    """Cleans up worker's DinD container and copies boilerplate before running test,
+    tests marked with `fake_docker` only need boilerplates and `no_dind` nothing"""
+    if request.node.get_closest_marker("no_dind"):
+        return
+
+    request.getfixturevalue("boilerplates")
+    if request.node.get_closest_marker("fake_docker"):
+        return
+
+    container_id = request.getfixturevalue("worker_dind_container")
+    reset_test_state()
+    reset_dind_container()
     copy_flavour_to_container(
         *parse_flavour_version(path.basename(request.node.fspath)),
         container_id=container_id,
     )
-    request.addfinalizer(teardown_function)
-
-
-def teardown_function():
-    """Cleans up boilerplates and stops containers after running test"""
-    stop_dind_container()
@@ -0,0 +1,56 @@
+"""Checks that the build context streamed to `docker build` honours .dockerignore"""
+import tarfile
+from io import BytesIO
+from subprocess import run
+
+import pytest
+
+from lib.dind_sync import get_context_filter_cmd
+
+pytestmark = pytest.mark.no_dind
+
+DOCKERIGNORE = "node_modules\n.git\n*.log\n!keep.log\nlogs/\ndocker/Dockerfile\n"
+FILES = [
+    "src/app.js",
+    "node_modules/package/index.js",
+    ".git/HEAD",
+    "docker/Dockerfile",
+    "debug.log",
+    "keep.log",
+    "logs/app.txt",
+]
+
+
+def filter_context(project_root: str) -> list:
+    """Tars the project the way `docker cp` does and filters it"""
+    ret = run(
+        f'tar -C "{project_root}" -cf - . | {get_context_filter_cmd(project_root)}',
+        shell=True,
+        capture_output=True,
+        check=True,
+    )
+    with tarfile.open(fileobj=BytesIO(ret.stdout)) as tar:
+        return sorted(name.removeprefix("./") for name in tar.getnames())
+
+
+def test_context_skips_dockerignored_files(tmp_path):
+    """Ignored files and directories are not in the context, Dockerfile is kept"""
+    (tmp_path / ".dockerignore").write_text(DOCKERIGNORE, encoding="utf-8")
+    for name in FILES:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(name, encoding="utf-8")
+
+    assert filter_context(str(tmp_path)) == [
+        ".",
+        ".dockerignore",
+        "docker",
+        "docker/Dockerfile",
+        "keep.log",
+        "src",
+        "src/app.js",
+    ]
+
+
+def test_context_not_filtered_without_dockerignore(tmp_path):
+    """There's nothing to filter without .dockerignore"""
+    assert get_context_filter_cmd(str(tmp_path)) == ""
@@ -1,6 +1,7 @@
 import pytest
 
 from lib.misc import get_platform
+from lib.tests.boilerplates import copy_flavour_to_container, get_project_root
 from lib.tests.dekick_commands import (
     dekick_build,
     dekick_dotenv_replace,
@@ -8,9 +9,12 @@ from lib.tests.dekick_commands import (
     dekick_status,
     dekick_stop,
     dekick_test,
+    reset_test_state,
 )
+from lib.tests.dind import get_dind_container_id, rbash_dind, reset_dind_container
 from lib.tests.docker import any_container_running, no_container_running
 from lib.tests.misc import parse_flavour_version
+from lib.tests.snapshots import is_snapshots_enabled, restore_snapshot
 
 FLAVOUR, VERSION = parse_flavour_version(__file__)
 
@@ -80,3 +84,26 @@ def test_build_app_env_production():
     """
     assert dekick_dotenv_replace(FLAVOUR, VERSION, {"APP_ENV": "production"})
     assert dekick_build(FLAVOUR, VERSION)
+
+
+@pytest.mark.command_local
+@pytest.mark.extended
+@pytest.mark.skipif(not is_snapshots_enabled(), reason="snapshots are disabled")
+def test_local_snapshot_restore_into_populated_project():
+    """Tests snapshot is restored over the copied boilerplate and changes made by
+    the test are applied again"""
+    assert dekick_local(FLAVOUR, VERSION)
+
+    reset_dind_container()
+    copy_flavour_to_container(FLAVOUR, VERSION, container_id=get_dind_container_id())
+    assert restore_snapshot(FLAVOUR, VERSION)
+
+    reset_dind_container()
+    copy_flavour_to_container(FLAVOUR, VERSION, container_id=get_dind_container_id())
+    reset_test_state()
+    assert dekick_dotenv_replace(FLAVOUR, VERSION, {"APP_ENV": "production"})
+    assert dekick_local(FLAVOUR, VERSION)
+    assert any_container_running()
+    assert "APP_ENV=production" in rbash_dind(
+        "Reading .env file", f'cat "{get_project_root()}/.env"'
+    )["stdout"]
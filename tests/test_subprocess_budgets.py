@@ -0,0 +1,46 @@
+"""Checks how many `docker` calls DeKick commands make, using fake docker"""
+import pytest
+
+from lib.tests.fake_docker import run_dekick_with_fake_docker
+
+pytestmark = pytest.mark.fake_docker
+
+FLAVOUR, VERSION = "laravel", "php8_2"
+SERVICES = ["web", "db"]
+
+
+def get_status_responses(running: list) -> list:
+    """Responses of `docker compose` for `dekick status`"""
+    return [
+        {
+            "args": ["compose", "config", "--services"],
+            "stdout": "\n".join(SERVICES) + "\n",
+        }
+    ] + [
+        {
+            "args": ["compose", "ps", "--services", "--filter", "status=running"]
+            + [service],
+            "stdout": f"{service}\n" if service in running else "",
+        }
+        for service in SERVICES
+    ]
+
+
+def test_status_docker_calls():
+    """`dekick status` lists services once and checks each of them once"""
+    ret = run_dekick_with_fake_docker(
+        ["status"], FLAVOUR, VERSION, get_status_responses(SERVICES)
+    )
+
+    assert ret["code"] == 0
+    assert len(ret["invocations"]) <= 1 + len(SERVICES)
+
+
+def test_status_stops_on_first_not_running_service():
+    """`dekick status` fails without checking services after the first one down"""
+    ret = run_dekick_with_fake_docker(
+        ["status"], FLAVOUR, VERSION, get_status_responses([])
+    )
+
+    assert ret["code"] == 1
+    assert len(ret["invocations"]) == 2